@@ -4,17 +4,20 @@ api.py - Create and configure the Sea Battle Game API exposing the resources.
 """
 
 import endpoints
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 from protorpc import remote, messages, message_types
 
-from bombers import PlayerBomber, OpponentBomber
+from bombers import OPPONENT_BOMBERS, play_turn
+from engine import PLAYER
+from leaderboard import ALL_TIME
 from models import GameForm, GameForms, MakeMoveForm
-from models import RankingForms, UserRankingForm
+from models import MakeMovesForm, MoveResultForm, MovesResultForm
+from models import RankingForms
 from models import ScoreForms, GameHistoryForm
 from models import StringMessage, NewGameForm
-from models import User, Game, Ship, Bomb, Score
-from utils import get_by_urlsafe
+from models import ActiveGamesCounter
+from models import User, Game, Score, UserStats
+from utils import fetch_page, get_by_urlsafe, get_key_by_urlsafe
 
 __author__ = 'Andres Anies'
 __email__ = 'andres_anies@hotmail.com'
@@ -22,15 +25,33 @@ __email__ = 'andres_anies@hotmail.com'
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1), )
+GET_GAME_STATE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    known_moves=messages.IntegerField(2, required=False))
+GET_GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    encoded=messages.BooleanField(2, required=False))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1), )
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1), )
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1, required=False),
+    page_token=messages.StringField(2, required=False))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, required=False),
+    page_token=messages.StringField(3, required=False))
 HIGH_SCORES_REQUEST = endpoints.ResourceContainer(
-    number_of_results=messages.IntegerField(1, required=False))
+    number_of_results=messages.IntegerField(1, required=False),
+    period=messages.StringField(2, required=False))
 
-MEMCACHE_AVERAGE_MOVES = 'MOVES_REMAINING'
+# Number of moves accepted by make_moves, enough to bomb the whole grid
+MAX_MOVES = 100
 
 
 @endpoints.api(name='sea_battle', version='v1')
@@ -44,11 +65,14 @@ class SeaBattleApi(remote.Service):
                       http_method='POST')
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        try:
+            user = (not User.get_by_name(request.user_name) and
+                    User.create(request.user_name, request.email))
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        if not user:
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
@@ -59,55 +83,59 @@ class SeaBattleApi(remote.Service):
                       http_method='POST')
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        user = self._get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
 
         try:
-            game = Game.new_game(user.key, request.ships)
+            game = Game.new_game(user.key, request.ships,
+                                 request.opponent_strategy, user.name)
         except ValueError as e:
             raise endpoints.BadRequestException(str(e))
 
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
         return game.to_form(u'Sink ´em all!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GET_GAME_STATE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return the current game state, or its changes after the moves
+        known by the client."""
+        game = self._get_game(request.urlsafe_game_key)
         if game:
-            return game.to_form('Time to make a move!')
+            return game.to_form('Time to make a move!',
+                                known_moves=request.known_moves)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GET_GAME_HISTORY_REQUEST,
                       response_message=GameHistoryForm,
                       path='game_history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
     def get_game_history(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = self._get_game(request.urlsafe_game_key)
         if game:
-            return game.to_history_form()
+            return game.to_history_form(encoded=bool(request.encoded))
         else:
             raise endpoints.NotFoundException('Game not found!')
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of all scores, the latest first"""
+        scores, next_page_token = fetch_page(
+            Score.query().order(-Score.date, Score.key),
+            request.page_size, request.page_token)
+        return ScoreForms(items=Score.to_forms(scores),
+                          next_page_token=next_page_token)
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
@@ -116,48 +144,121 @@ class SeaBattleApi(remote.Service):
                       http_method='PUT')
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        try:
+            game, message = self._play_turn(
+                get_key_by_urlsafe(request.urlsafe_game_key, Game),
+                request.bomb, request.move_id)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+        return game.to_form(message, known_moves=request.known_moves)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _play_turn(game_key, bomb, move_id=None):
+        """Drops the player bomb and the opponent response bomb(s) inside a
+        transaction that commits all the changes of the turn at once, so
+        concurrent moves of the same game can't be both applied. The game is
+        got, and migrated if stored with the old key based layout, in the
+        same transaction. If move_id is the id of the last applied move the
+        stored result is returned instead of playing the turn again. Returns
+        the game and the message of the move"""
+        game = Game.embed_legacy_game(game_key)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
+        if move_id and move_id == game.last_move_id:
+            return game, game.last_move_message
+
         # Check if the game is already over
         if game.game_over:
-            return game.to_form('Game already over!')
-
+            return game, 'Game already over!'
+
+        battle = game.to_battle()
+        message = play_turn(battle, bomb,
+                            OPPONENT_BOMBERS[game.opponent_strategy])
+
+        # Check if the new player bomb or the opponent bomb(s) if any
+        # caused the end of the game
+        if battle.game_over:
+            message = 'You won!' if battle.winner == PLAYER else 'You loose!'
+
+        game.last_move_id = move_id
+        game.last_move_message = message
+        game.save_battle(battle)
+        return game, message
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MovesResultForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    def make_moves(self, request):
+        """Makes a list of moves in a row. Returns the result of each move
+        and the new game state"""
+        if len(request.bombs) > MAX_MOVES:
+            raise endpoints.BadRequestException(
+                'At most {} moves can be made at once'.format(MAX_MOVES))
         try:
-            Ship.validate_square(request.bomb)
-            result = PlayerBomber(game, request.bomb).bomb_ships()
-            # Check if the new player bomb caused the end of the game
-            if game.game_over:
-                return game.to_form('You won!')
-
-            if game.player_bombs[-1].get().result != Bomb.HIT:
-                OpponentBomber(game).bomb_ships()
-                while game.opponent_bombs[-1].get().result == Bomb.HIT:
-                    OpponentBomber(game).bomb_ships()
-
-            # Check if the new opponent bomb(s) if any  caused
-            # the end of the game
-            if game.game_over:
-                return game.to_form('You loose!')
-
-            return game.to_form(result)
-
+            game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
         except ValueError as e:
             raise endpoints.BadRequestException(str(e))
 
-    @endpoints.method(request_message=USER_REQUEST,
+        game, results, message = self._play_turns(game_key, request.bombs)
+        return MovesResultForm(
+            results=results,
+            game=game.to_form(message, known_moves=request.known_moves))
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _play_turns(game_key, bombs):
+        """Plays a turn for each bomb inside a single transaction until the
+        game is over or a bomb is invalid. The game is got, and migrated if
+        stored with the old key based layout, in the same transaction.
+        Returns the game, the MoveResultForms of the bombs dropped or refused
+        and the message of the last move"""
+        game = Game.embed_legacy_game(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            return game, [], 'Game already over!'
+
+        battle = game.to_battle()
+        opponent_bomber_class = OPPONENT_BOMBERS[game.opponent_strategy]
+        results = []
+        message = 'Time to make a move!'
+        for bomb in bombs:
+            if battle.game_over:
+                break
+            try:
+                message = play_turn(battle, bomb, opponent_bomber_class)
+            except ValueError as e:
+                results.append(MoveResultForm(bomb=bomb, error=str(e)))
+                break
+            results.append(MoveResultForm(bomb=bomb, result=message))
+
+        if battle.game_over:
+            message = 'You won!' if battle.winner == PLAYER else 'You loose!'
+
+        if any(result.result for result in results):
+            game.save_battle(battle)
+        return game, results, message
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of an individual User's scores, the latest first"""
+        user = self._get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores, next_page_token = fetch_page(
+            Score.query(Score.user == user.key).order(-Score.date, Score.key),
+            request.page_size, request.page_token)
+        return ScoreForms(items=Score.to_forms(scores),
+                          next_page_token=next_page_token)
 
     @endpoints.method(request_message=HIGH_SCORES_REQUEST,
                       response_message=ScoreForms,
@@ -165,55 +266,56 @@ class SeaBattleApi(remote.Service):
                       name='get_high_scores',
                       http_method='GET')
     def get_high_scores(self, request):
-        """Return the high scores"""
-        scores = Score.query(Score.won == True).order(Score.bombs).fetch(
-            limit=request.number_of_results)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Return the high scores of all time or of the day"""
+        try:
+            scores = Score.get_high_scores(
+                request.period or ALL_TIME, request.number_of_results)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        return ScoreForms(items=scores)
 
-    @endpoints.method(response_message=RankingForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=RankingForms,
                       path='user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
     def get_user_rankings(self, request):
-        """Return the all players ranked by performance"""
-        users = User.query()
-        rankings = []
-        for user in users:
-            wins = len(Score.query(
-                Score.user == user.key, Score.won == True).fetch())
-            loses = len(Score.query(
-                Score.user == user.key, Score.won == False).fetch())
-            performance = wins / (loses + 1.0)
-            rankings.append(UserRankingForm(
-                name=user.name, performance=performance))
-
-        rankings = sorted(
-            rankings, key=lambda ranking: ranking.performance, reverse=True)
-
-        return RankingForms(items=rankings)
+        """Return a page of the players ranked by performance"""
+        stats, next_page_token = fetch_page(
+            UserStats.query().order(-UserStats.performance, UserStats.key),
+            request.page_size, request.page_token)
+        return RankingForms(
+            items=[user_stats.to_form() for user_stats in stats],
+            next_page_token=next_page_token)
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts',
                       http_method='GET')
     def get_average_attempts(self, request):
-        """Get the cached average moves(bombs) dropped"""
-        return StringMessage(
-            message=memcache.get(MEMCACHE_AVERAGE_MOVES) or '')
+        """Get the average moves(bombs) dropped in the active games"""
+        games, bombs = ActiveGamesCounter.totals()
+        if games <= 0:
+            return StringMessage(message='')
+        return StringMessage(message='The average number of dropped bombs '
+                                     'are {:.2f}'.format(float(bombs) / games))
+
+    @staticmethod
+    def _get_user(user_name):
+        """Returns the user with the given name or None"""
+        try:
+            return User.get_by_name(user_name)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
 
     @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average number of
-        dropped bombs(attempts) of unfinished Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_dropped_bombs = sum([len(game.player_bombs)
-                                       for game in games])
-            average = float(total_dropped_bombs) / count
-            memcache.set(MEMCACHE_AVERAGE_MOVES,
-                         'The average number of '
-                         'dropped bombs are {:.2f}'.format(average))
+    def _get_game(urlsafe_game_key):
+        """Returns the game that the urlsafe key points to, embedding its
+        ships and bombs first if it was stored with the old key based layout"""
+        game = get_by_urlsafe(urlsafe_game_key, Game)
+        if game and game.legacy_keys:
+            game = Game.embed_legacy_game(game.key)
+        return game
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=GameForms,
@@ -222,13 +324,16 @@ class SeaBattleApi(remote.Service):
                       http_method='GET')
     def get_user_games(self, request):
         """Returns all of an individual User's games"""
-        user = User.query(User.name == request.user_name).get()
+        user = self._get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        games = Game.query(Game.player == user.key, Game.game_over == False)
-        return GameForms(
-            items=[game.to_form(u'Sink ´em all!') for game in games])
+        games = Game.query(
+            Game.player == user.key, Game.game_over == False).fetch()
+        games = [Game.embed_legacy_game(game.key) if game.legacy_keys
+                 else game for game in games]
+        return GameForms(items=Game.to_forms(
+            [game for game in games if game], u'Sink ´em all!'))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       path='game/{urlsafe_game_key}',
@@ -244,10 +349,9 @@ class SeaBattleApi(remote.Service):
                 raise endpoints.UnauthorizedException(
                     'You are not authorized to cancel that game')
 
-            game.key.delete()
-            return message_types.VoidMessage()
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+            if game.cancel():
+                return message_types.VoidMessage()
+        raise endpoints.NotFoundException('Game not found!')
 
 
 api = endpoints.api_server([SeaBattleApi])
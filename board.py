@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+board.py: Bitboard representation of the game grid. Every square of the
+10 x 10 grid is mapped to one bit of an integer, so a set of squares (a ship,
+a fleet or the bombs dropped by a side) is held by a single mask and the
+game checks become bitwise operations.
+"""
+
+__author__ = 'Andres Anies'
+__email__ = 'andres_anies@hotmail.com'
+
+GRID_SIZE = 10
+ROWS = 'ABCDEFGHIJ'
+
+EMPTY = 0
+FULL = (1 << (GRID_SIZE * GRID_SIZE)) - 1
+
+# Masks used to avoid wrapping around the grid edges when a mask is shifted
+FIRST_COLUMN = sum(1 << (row * GRID_SIZE) for row in range(GRID_SIZE))
+LAST_COLUMN = FIRST_COLUMN << (GRID_SIZE - 1)
+
+
+# Tables of the grid built once at import time, so the squares are parsed
+# and their neighbours and runs are looked up instead of being calculated
+ROW_NUMBERS = dict((row, number) for number, row in enumerate(ROWS, 1))
+# Label of each square index, interned so every equal label is one string
+SQUARES = tuple(intern('%s%d' % (ROWS[index // GRID_SIZE],
+                                 index % GRID_SIZE + 1))
+                for index in range(GRID_SIZE * GRID_SIZE))
+SQUARE_INDEXES = dict((square, index)
+                      for index, square in enumerate(SQUARES))
+SQUARE_MASKS = tuple(1 << index for index in range(GRID_SIZE * GRID_SIZE))
+
+
+def _neighbour(index, row_step, column_step):
+    """Returns the square at a relative position of a square index or None if
+    it falls out of the grid"""
+    row, column = divmod(index, GRID_SIZE)
+    row, column = row + row_step, column + column_step
+    if 0 <= row < GRID_SIZE and 0 <= column < GRID_SIZE:
+        return SQUARES[row * GRID_SIZE + column]
+
+
+def _build_runs():
+    """Returns the squares indexes of every run of squares which fits in the
+    grid by its start index, orientation (vertical or not) and length"""
+    runs = {}
+    for index in range(GRID_SIZE * GRID_SIZE):
+        row, column = divmod(index, GRID_SIZE)
+        for vertical, free_squares, step in [
+                (True, GRID_SIZE - row, GRID_SIZE),
+                (False, GRID_SIZE - column, 1)]:
+            for length in range(1, free_squares + 1):
+                runs[index, vertical, length] = tuple(
+                    range(index, index + length * step, step))
+    return runs
+
+
+# Squares at the next row, the previous row, the previous column and the next
+# column of each square index
+NEIGHBOUR_SQUARES = tuple(
+    (_neighbour(index, 1, 0), _neighbour(index, -1, 0),
+     _neighbour(index, 0, -1), _neighbour(index, 0, 1))
+    for index in range(GRID_SIZE * GRID_SIZE))
+NEIGHBOUR_INDEXES = tuple(
+    tuple(None if square is None else SQUARE_INDEXES[square]
+          for square in squares)
+    for squares in NEIGHBOUR_SQUARES)
+RUNS = _build_runs()
+RUN_MASKS = dict((key, sum(SQUARE_MASKS[index] for index in indexes))
+                 for key, indexes in RUNS.items())
+
+
+def square_index(square):
+    """Returns the position (0 to 99) of a square like 'B10' in the grid.
+    Raises a ValueError if the square is not in the grid"""
+    try:
+        return SQUARE_INDEXES[square]
+    except KeyError:
+        raise ValueError('Invalid square')
+
+
+def square_label(index):
+    """Returns the square name of a given grid position"""
+    return SQUARES[index]
+
+
+def square_mask(square):
+    """Returns the mask with only the bit of the given square set"""
+    return SQUARE_MASKS[square_index(square)]
+
+
+def run(start_index, vertical, length):
+    """Returns the squares indexes of a run of squares that starts at a grid
+    position and follows the vertical or horizontal orientation, or None if
+    it doesn't fit in the grid"""
+    return RUNS.get((start_index, vertical, length))
+
+
+def squares_mask(squares):
+    """Returns the mask of a list of squares"""
+    mask = EMPTY
+    for square in squares:
+        mask |= SQUARE_MASKS[square_index(square)]
+    return mask
+
+
+def mask_indexes(mask):
+    """Returns the grid positions set in a mask in ascending order"""
+    indexes = []
+    while mask:
+        lowest_bit = mask & -mask
+        indexes.append(lowest_bit.bit_length() - 1)
+        mask ^= lowest_bit
+    return indexes
+
+
+def mask_squares(mask):
+    """Returns the squares set in a mask in ascending order (by row and
+    then by column)"""
+    return [square_label(index) for index in mask_indexes(mask)]
+
+
+def count(mask):
+    """Returns the number of squares set in a mask"""
+    return bin(mask).count('1')
+
+
+def ship_mask(length, start_index, vertical):
+    """Returns the mask of a ship of a given length that starts at a grid
+    position and follows the vertical or horizontal orientation. The ship
+    is expected to fit in the grid"""
+    return RUN_MASKS[start_index, vertical, length]
+
+
+def neighbours_mask(mask):
+    """Returns the mask of the squares at the top, bottom, left or right of
+    any square of the given mask which are not part of the mask itself"""
+    spread = ((mask << GRID_SIZE) | (mask >> GRID_SIZE) |
+              ((mask & ~LAST_COLUMN) << 1) | ((mask & ~FIRST_COLUMN) >> 1))
+    return spread & FULL & ~mask
+
+
+def union(masks):
+    """Returns the mask with the squares of all the given masks, like the
+    occupancy of a whole fleet"""
+    mask = EMPTY
+    for item in masks:
+        mask |= item
+    return mask
+
+
+_placements = {}
+
+
+def placements(length):
+    """Returns every position in which a ship of a given length fits in the
+    grid as (mask, start index, vertical, squares indexes) tuples. A ship of
+    length one has a single placement per square. They are calculated once
+    per length"""
+    if length not in _placements:
+        fitting_placements = []
+        for vertical in (True, False)[:1 if length == 1 else 2]:
+            for index in range(GRID_SIZE * GRID_SIZE):
+                row, column = divmod(index, GRID_SIZE)
+                if (row if vertical else column) + length <= GRID_SIZE:
+                    mask = ship_mask(length, index, vertical)
+                    fitting_placements.append(
+                        (mask, index, vertical, tuple(mask_indexes(mask))))
+        _placements[length] = fitting_placements
+    return _placements[length]
@@ -5,226 +5,220 @@ bombers.py: Holds validators and generators of bombs.
 
 import random
 
-from models import Bomb
-from models import Ship
+import board
+from engine import Bomb
+from engine import Ship
+from engine import Target
 
 __author__ = 'Andres Anies'
 __email__ = 'andres_anies@hotmail.com'
 
+HUNT_STRATEGY = 'hunt'
+DENSITY_STRATEGY = 'density'
+
 
 class PlayerBomber(object):
     """Validates and calculates the result of a player bomb"""
 
-    def __init__(self, game, bomb):
-        self.game = game
+    def __init__(self, battle, bomb):
+        self.battle = battle
+        self.side = battle.player
         self.bomb = bomb
-        self.target_ships = [ship_key.get()
-                             for ship_key in self.game.opponents_ships]
-        self.sunken_ships = self.game.sunken_opponents_ships
 
     @property
     def bombs(self):
-        return [bomb.get() for bomb in self.game.player_bombs]
-
-    @property
-    def bombs_squares(self):
-        return [bomb.target_square for bomb in self.bombs]
+        return self.side.bombs
 
     def bomb_ships(self):
         """Executes the player's bombing and returns its result checking a
         possible sinking ship or a game over"""
-        if self.bomb in self.bombs_squares:
-            raise ValueError('That bomb has already been dropped!')
+        Ship.validate_square(self.bomb)
+        return self._drop_bomb()
 
-        bomb_key, bombed_ship, result = self.get_bomb_result()
-        self.game.player_bombs.append(bomb_key)
-        self.game.put()
+    def _drop_bomb(self):
+        """Drops the bomb against the fleet of the side and returns its
+        result"""
+        return self.battle.drop_bomb(self.side, self.bomb)
 
-        if bombed_ship:
-            if self._is_sunken_ship(bombed_ship):
-                self._check_if_game_is_over()
 
-        return result
+class OpponentBomber(PlayerBomber):
+    """Generates, validates and calculates the result of an opponent bomb.
+    The hits on the ships not sunken yet, their orientation and the squares
+    to bombard next are kept in the battle target and updated after every
+    bomb, so a bomb is chosen without going through the bombs dropped"""
 
-    def get_bomb_result(self):
-        """Searches for a opponent ship that fills the same square as the
-        dropped bomb by the player, and if so the result will be a 'Hit'
-        otherwise a 'Mis'. Creates and saves in the database the Bomb's model
-        instance. Returns its key, result and the beaten ship if there is one"""
-        result = Bomb.MIS
-        bombed_ship = None
-        for target_ship in self.target_ships:
-            if self.bomb in target_ship.squares:
-                bombed_ship, result = target_ship, Bomb.HIT
-                break
+    # Orientation of the ship a hit belongs to if the next row, the previous
+    # row, the previous column or the next column square is part of it
+    NEIGHBOUR_ORIENTATIONS = (Ship.VERTICAL, Ship.VERTICAL,
+                              Ship.HORIZONTAL, Ship.HORIZONTAL)
 
-        bomb = Bomb(target_square=self.bomb, result=result)
-        bomb.put()
+    def __init__(self, battle):
+        super(OpponentBomber, self).__init__(battle, None)
+        self.side = battle.opponent
 
-        return bomb.key, bombed_ship, result
+    @property
+    def target(self):
+        """Returns the targeting state of the battle, working it out from the
+        bombs dropped if the battle has none"""
+        if self.battle.target is None:
+            open_hits = self.side.hits_mask & ~self.side.sunken_mask
+            self.battle.target = Target(
+                [board.square_index(bomb.target_square) for bomb in self.bombs
+                 if board.square_mask(bomb.target_square) & open_hits])
+            self._aim()
+        return self.battle.target
 
-    def _is_sunken_ship(self, ship):
-        """Checks if a given ship has all its squares bombarded and it should
-        be marked as a sunken ship"""
-        for square in ship.squares:
-            if square not in self.bombs_squares:
-                return
+    def bomb_ships(self):
+        """Bombards the next queued square of the target not bombed yet, or a
+        random square if there is none, to find and sink the rest of a
+        partially sunken ship. Returns the bomb result"""
+        target = self.target
+        while target.frontier:
+            index = target.frontier.pop(0)
+            if not board.SQUARE_MASKS[index] & self.side.bombs_mask:
+                return self._bomb_target(index)
+
+        return self._bomb_target(random.choice(self.side.free_squares))
+
+    def _bomb_target(self, index):
+        """Drops a bomb at a grid position and updates the target with its
+        result: a hit is added to the target hits unless it sinks a ship, in
+        which case the hits of that ship are removed"""
+        target = self.target
+        sunken_ships = len(self.side.sunken_ships)
+        result = self._save_bomb(board.square_label(index))
+        if result == Bomb.HIT:
+            if len(self.side.sunken_ships) > sunken_ships:
+                ship_mask = self.side.ships_masks[self.side.sunken_ships[-1]]
+                target.hits = [hit for hit in target.hits
+                               if not board.SQUARE_MASKS[hit] & ship_mask]
+            else:
+                target.hits.append(index)
+            self._aim()
+        return result
 
-        self.sunken_ships.append(ship.key)
-        self.game.put()
-        return True
+    def _aim(self):
+        """Guesses the orientation of the target ship from its first two hits
+        and queues the squares next to the hits not bombed yet, the ones
+        following that orientation in line with the hits first"""
+        target = self.target
+        hits = target.hits
+        target.orientation = None
+        target.frontier = []
+        if not hits:
+            return
+
+        first_row, first_column = divmod(hits[0], board.GRID_SIZE)
+        if len(hits) > 1:
+            second_row, second_column = divmod(hits[1], board.GRID_SIZE)
+            if first_row == second_row:
+                target.orientation = Ship.HORIZONTAL
+            elif first_column == second_column:
+                target.orientation = Ship.VERTICAL
+
+        in_line, others = [], []
+        queued_mask = self.side.bombs_mask
+        for hit in hits:
+            if target.orientation == Ship.HORIZONTAL:
+                hit_in_line = hit // board.GRID_SIZE == first_row
+            else:
+                hit_in_line = hit % board.GRID_SIZE == first_column
+            for orientation, neighbour in zip(self.NEIGHBOUR_ORIENTATIONS,
+                                              board.NEIGHBOUR_INDEXES[hit]):
+                if neighbour is None or \
+                        board.SQUARE_MASKS[neighbour] & queued_mask:
+                    continue
+                queued_mask |= board.SQUARE_MASKS[neighbour]
+                if hit_in_line and orientation == target.orientation:
+                    in_line.append(neighbour)
+                else:
+                    others.append(neighbour)
+        target.frontier = in_line + others
 
-    def _check_if_game_is_over(self):
-        """Checks if the player or the opponent have sunken all the enemy ships
-        so the game has come to the end"""
-        if len(self.game.sunken_opponents_ships) == 10:
-            self.game.end_game(won=True)
+    def _bomb_random_square(self):
+        """Drops a bomb in any available square, drawn once from the squares
+        not bombed yet"""
+        return self._save_bomb(self.side.random_free_square())
 
-        if len(self.game.sunken_players_ships) == 10:
-            self.game.end_game()
+    def _save_bomb(self, bomb):
+        """Drops the bomb against the player's fleet and returns its result"""
+        self.bomb = bomb
+        return self._drop_bomb()
 
 
-class OpponentBomber(PlayerBomber):
-    """Generates, validates and calculates the result of an opponent bomb"""
+class DensityOpponentBomber(OpponentBomber):
+    """Drops the opponent bombs at the square most likely to hold a player
+    ship. Every placement of the remaining player ships which is consistent
+    with the missed bombs, the sunken ships and the open hits adds its weight
+    to the squares it covers, and the unbombed square with the highest
+    total is bombarded"""
 
-    def __init__(self, game):
-        super(OpponentBomber, self).__init__(game, None)
-        self.game = game
-        self.target_ships = [ship_key.get()
-                             for ship_key in self.game.players_ships]
-        self.sunken_ships = self.game.sunken_players_ships
-
-    @property
-    def bombs(self):
-        return [bomb.get() for bomb in self.game.opponent_bombs]
+    # Weight multiplier per open hit covered by a placement, so the squares
+    # next to a partially sunken ship are bombarded first
+    HIT_WEIGHT = 50
 
     def bomb_ships(self):
-        """Generates a random bomb to be dropped in the player's fleet if
-        there is not a ship partially sunken else find the rest of the ship
-        and bombard it until has been sunken"""
-        latest_hit_bombs = self._get_latest_hit_bombs()
-        if latest_hit_bombs:
-
-            if len(latest_hit_bombs) == 1:
-                self._bomb_nearby_squares(latest_hit_bombs)
-            else:
-
-                if self.bombs[-1].result == Bomb.HIT:
-                    self._bomb_with_same_last_orientation_and_direction(
-                        latest_hit_bombs)
+        """Bombards the most likely square and returns the bomb result"""
+        densities = self.get_densities()
+        best_density = max(densities)
+        if not best_density:
+            return self._bomb_random_square()
+
+        best_squares = [index for index, density in enumerate(densities)
+                        if density == best_density]
+        return self._save_bomb(board.square_label(random.choice(best_squares)))
+
+    def get_densities(self):
+        """Returns the weight of every square of the grid, zero for the
+        squares which were already bombarded"""
+        side = self.side
+        open_hits = side.hits_mask & ~side.sunken_mask
+        # No ship can be placed on a missed square nor on a sunken ship, the
+        # player ships may touch each other so their neighbours stay open
+        missed_mask = side.bombs_mask & ~side.hits_mask
+        blocked_mask = missed_mask | side.sunken_mask
+
+        remaining_ships = {}
+        for index, ship in enumerate(side.ships):
+            if index not in side.sunken_ships:
+                remaining_ships[ship.type] = remaining_ships.get(
+                    ship.type, 0) + 1
+
+        densities = [0] * (board.GRID_SIZE * board.GRID_SIZE)
+        for length, count in remaining_ships.items():
+            for mask, _, _, squares in board.placements(length):
+                if mask & blocked_mask:
+                    continue
+                covered_hits = mask & open_hits
+                if covered_hits:
+                    weight = count * self.HIT_WEIGHT ** board.count(
+                        covered_hits)
                 else:
-                    self._bomb_with_same_last_orientation(latest_hit_bombs)
-
-        else:
-            self._bomb_random_square()
-
-    def _get_latest_hit_bombs(self):
-        """Returns the latest bombs that had hit a partially sunken ship"""
-        latest_hit_bombs = []
-
-        sunken_ships_squares = []
-        for ship_key in self.game.sunken_players_ships:
-            for square in ship_key.get().squares:
-                sunken_ships_squares.append(square)
-
-        for bomb in self.bombs:
-            if bomb.result == Bomb.HIT and (
-                        bomb.target_square not in sunken_ships_squares):
-                latest_hit_bombs.append(bomb.target_square)
-
-        return latest_hit_bombs
-
-    def _bomb_nearby_squares(self, latest_hit_bombs):
-        """Finds the rest of the squares of a partially sunken ship
-        and bombard it guessing the position of the next square of that ship"""
-        latest_bomb = latest_hit_bombs[0]
-        nearby_squares = self._get_nearby_squares(latest_bomb)
-        self._try_bombs(nearby_squares)
-
-    def _get_nearby_squares(self, square):
-        """Finds all nearby(top, down, left and right) squares
-        of a given square"""
-        nearby_rows = [chr(ord(square[0]) - 1), chr(ord(square[0]) + 1)]
-        nearby_columns = [int(square[1:]) - 1, int(square[1:]) + 1]
-
-        top_square = "%s%s" % (nearby_rows[1], square[1:])
-        down_square = "%s%s" % (nearby_rows[0], square[1:])
-        left_square = "%s%s" % (square[0], nearby_columns[0])
-        right_square = "%s%s" % (square[0], nearby_columns[1])
-        return [top_square, down_square, left_square, right_square]
-
-    def _try_bombs(self, nearby_squares):
-        """Tries to guess the next square of the partially sunken ship bombarding
-        if possible a nearby square of the latest bomb that was a hit"""
-        for possible_bomb in nearby_squares:
-            try:
-                Ship.validate_square(possible_bomb)
-                if possible_bomb not in self.bombs_squares:
-                    self._save_bomb(possible_bomb)
-                    break
-            except ValueError:
-                continue
-
-    def _bomb_with_same_last_orientation(self, latest_hit_bombs):
-        """Tries to guess the next square of the partially sunken ship
-         knowing that the possible Hit will be in the same orientation
-         of the last hit"""
-        latest_bomb = latest_hit_bombs[0]
-        second_latest_bomb = latest_hit_bombs[1]
-
-        nearby_squares = self._get_nearby_squares(latest_bomb)
-        nearby_squares_vertically = nearby_squares[:2]
-        nearby_squares_horizontally = nearby_squares[2:]
-
-        if latest_bomb[0] == second_latest_bomb[0]:
-            # We guess player ship is in horizontal orientation
-            self._try_bombs(nearby_squares_horizontally)
-        else:
-            # We guess player ship is in vertical orientation
-            self._try_bombs(nearby_squares_vertically)
-
-    def _bomb_with_same_last_orientation_and_direction(self, latest_hit_bombs):
-        """Guesses the next square of the partially sunken ship
-         knowing that the possible Hit will be in the same orientation and
-         the same direction of the last hit"""
-        latest_bomb = latest_hit_bombs[-1]
-        second_latest_bomb = latest_hit_bombs[-2]
-
-        top_square, down_square, left_square, right_square = \
-            self._get_nearby_squares(latest_bomb)
-
-        if latest_bomb[0] == second_latest_bomb[0]:
-            # We guess player ship is in horizontal orientation
-            if second_latest_bomb == left_square:
-                self._try_bombs([right_square])
-            else:
-                self._try_bombs([left_square])
-        else:
-            # We guess player ship is in vertical orientation
-            if second_latest_bomb == down_square:
-                self._try_bombs([top_square])
-            else:
-                self._try_bombs([down_square])
+                    weight = count
+                for square in squares:
+                    densities[square] += weight
 
-    def _bomb_random_square(self):
-        """Drops a bomb in any available square"""
-        while True:
-            row = chr(64 + random.randint(1, 10))
-            column = random.randint(1, 10)
-            bomb = "%s%d" % (row, column)
-            if bomb not in self.bombs_squares:
-                self._save_bomb(bomb)
-                break
+        for square in board.mask_indexes(side.bombs_mask):
+            densities[square] = 0
+        return densities
 
-    def _save_bomb(self, bomb):
-        """Gets the bomb saved in the database and adds its key to the
-        opponent_bombs list of the current game. Check if there is a sunken
-        ship or the game has come to the end"""
-        self.bomb = bomb
-        bomb_key, bombed_ship, result = self.get_bomb_result()
-        self.game.opponent_bombs.append(bomb_key)
-        self.game.put()
 
-        if bombed_ship:
-            if self._is_sunken_ship(bombed_ship):
-                self._check_if_game_is_over()
+OPPONENT_BOMBERS = {
+    HUNT_STRATEGY: OpponentBomber,
+    DENSITY_STRATEGY: DensityOpponentBomber,
+}
+
+
+def play_turn(battle, bomb, opponent_bomber_class=OpponentBomber):
+    """Drops the player bomb and, if it missed, the opponent bombs until one
+    of them misses or the game comes to the end. Returns the result of the
+    player bomb"""
+    result = PlayerBomber(battle, bomb).bomb_ships()
+
+    if not battle.game_over and result != Bomb.HIT:
+        opponent_bomber = opponent_bomber_class(battle)
+        opponent_result = opponent_bomber.bomb_ships()
+        while not battle.game_over and opponent_result == Bomb.HIT:
+            opponent_result = opponent_bomber.bomb_ships()
+
+    return result
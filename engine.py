@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+engine.py: In memory implementation of the game rules. A battle is held by
+plain objects with no dependency on the datastore, so games can be played,
+simulated and benchmarked offline. The datastore models and the API are
+persistence adapters of these objects.
+"""
+
+import random
+
+import board
+from ships import ShipsGenerator
+from ships import ShipsManager
+
+__author__ = 'Andres Anies'
+__email__ = 'andres_anies@hotmail.com'
+
+BATTLESHIP = 4
+CRUISER = 3
+DESTROYER = 2
+SUBMARINE = 1
+
+TYPE_CHOICES = [BATTLESHIP, CRUISER, DESTROYER, SUBMARINE]
+
+TYPE_NAMES = {
+    BATTLESHIP: 'Battleship',
+    CRUISER: 'Cruiser',
+    DESTROYER: 'Destroyer',
+    SUBMARINE: 'Submarine',
+}
+
+VERTICAL = 1
+HORIZONTAL = 2
+ORIENTATION_CHOICES = [VERTICAL, HORIZONTAL]
+
+MIS = 'Mis'
+HIT = 'Hit'
+RESULT_CHOICES = [MIS, HIT]
+
+PLAYER = 'player'
+OPPONENT = 'opponent'
+# Bit of the moves of the opponent in a packed moves log
+OPPONENT_MOVE = 0x80
+
+
+class ShipRules(object):
+    """Validation rules and squares calculations shared by the ships of the
+    engine and the Ship datastore model"""
+    __slots__ = ()
+
+    BATTLESHIP = BATTLESHIP
+    CRUISER = CRUISER
+    DESTROYER = DESTROYER
+    SUBMARINE = SUBMARINE
+    TYPE_CHOICES = TYPE_CHOICES
+    TYPE_NAMES = TYPE_NAMES
+
+    VERTICAL = VERTICAL
+    HORIZONTAL = HORIZONTAL
+    ORIENTATION_CHOICES = ORIENTATION_CHOICES
+
+    @classmethod
+    def create_ship(cls, ship_type, star_square, orientation):
+        """Takes a ship components and returns a validated ship instance"""
+        cls.validate_ship(ship_type, star_square, orientation)
+        return cls(type=ship_type, star_square=star_square,
+                   orientation=orientation)
+
+    @classmethod
+    def validate_ship(cls, ship_type, star_square, orientation):
+        """Validates that the start square fits in the grid and has a correct
+        format, the type value is of a known option and the rest of the
+        squares of the ship fits in the game grid"""
+        try:
+            cls.validate_square(star_square)
+            cls.validate_type(ship_type)
+            cls.check_if_fit_in_grid(ship_type, star_square, orientation)
+        except ValueError as e:
+            raise ValueError('%s for %s at %s' % (
+                str(e), cls.TYPE_NAMES.get(ship_type, 'Ship'), star_square))
+
+    @classmethod
+    def validate_square(cls, square):
+        """Validates that the start square fits in the grid"""
+        if square in board.SQUARE_INDEXES:
+            return
+
+        if len(square) > 3:
+            raise ValueError('Invalid square')
+
+        cls._get_row_fow_letter(square[0])
+        square_column = int(square[1:])
+        if square_column not in range(1, 11):
+            raise ValueError('The number of the column must be '
+                             'an integer between 1 to 10')
+        # Other spellings of a square like 'A01' are not accepted
+        raise ValueError('Invalid square')
+
+    @classmethod
+    def _get_row_fow_letter(cls, letter):
+        """Gets a number representation of the row(used for
+        arithmetic operations)"""
+        try:
+            return board.ROW_NUMBERS[letter]
+        except KeyError:
+            raise ValueError('The letter of the row must '
+                             'be between A to J uppercase')
+
+    @classmethod
+    def validate_type(cls, ship_type):
+        """Checks if the selected type option is one of the allowed types"""
+        if ship_type not in cls.TYPE_CHOICES:
+            raise ValueError('Invalid ship type, options are: '
+                             '4 for BATTLESHIP, 3 for CRUISER '
+                             '2 for DESTROYER and 1 for SUBMARINE')
+
+    @classmethod
+    def check_if_fit_in_grid(cls, ship_type, start_square, orientation):
+        """Checks if all the squares in the ship fits in the game grid
+        so it's a valid ship"""
+        start_index = board.SQUARE_INDEXES.get(start_square)
+        if start_index is not None and board.run(
+                start_index, orientation == cls.VERTICAL, ship_type):
+            return
+
+        end_square = cls.get_end_square(ship_type, start_square, orientation)
+        try:
+            cls.validate_square(end_square)
+        except ValueError:
+            raise ValueError("Ship doesn't fit in sea grid")
+
+    @classmethod
+    def get_end_square(cls, ship_type, start_square, orientation):
+        """Calculates and returns the last square of a ship"""
+        ship_length = ship_type - 1
+        return cls.get_square_at_relative_position(
+            start_square, orientation, stepped_squares=ship_length)
+
+    @classmethod
+    def get_square_at_relative_position(
+            cls, start_square, orientation, stepped_squares):
+        """Calculates and returns the square of given position of a ship
+        like the second or third, etc"""
+        start_index = board.SQUARE_INDEXES.get(start_square)
+        if start_index is not None:
+            squares = board.run(start_index, orientation == cls.VERTICAL,
+                                stepped_squares + 1)
+            if squares:
+                return board.square_label(squares[-1])
+
+        # The square falls out of the grid, its label is still calculated
+        if orientation == cls.VERTICAL:
+            star_square_row = cls._get_row_fow_letter(start_square[0])
+            end_square_row = star_square_row + stepped_squares
+            end_square_row = chr(64 + end_square_row)
+        else:
+            end_square_row = start_square[0]
+
+        start_square_column = int(start_square[1:])
+        if orientation == cls.HORIZONTAL:
+            end_square_column = start_square_column + stepped_squares
+        else:
+            end_square_column = start_square_column
+
+        return '%s%d' % (end_square_row, end_square_column)
+
+    @property
+    def mask(self):
+        """Returns the bitboard mask of the squares filled by the ship"""
+        return board.ship_mask(self.type, board.square_index(self.star_square),
+                               self.orientation == self.VERTICAL)
+
+    @property
+    def squares(self):
+        """Calculates and returns all the squares that belong to the ship"""
+        return board.mask_squares(self.mask)
+
+    @property
+    def type_name(self):
+        """Returns a human readable ship type representation"""
+        return self.TYPE_NAMES[self.type]
+
+
+class Ship(ShipRules):
+    """Ship which forms part of the player or opponent fleet"""
+    __slots__ = ('type', 'star_square', 'orientation', 'sunken')
+
+    def __init__(self, type, star_square, orientation, sunken=False):
+        self.type = type
+        self.star_square = star_square
+        self.orientation = orientation
+        self.sunken = sunken
+
+
+class Bomb(object):
+    """Bomb dropped at a square and its result"""
+    __slots__ = ('target_square', 'result')
+
+    MIS = MIS
+    HIT = HIT
+
+    def __init__(self, target_square, result):
+        self.target_square = target_square
+        self.result = result
+
+
+class Side(object):
+    """A fleet under attack along with the bombs dropped against it and its
+    sunken ships, stored as positions of the fleet. The squares of the ships
+    and the bombs are also held as masks. The grid positions not bombed yet
+    are kept in a list along with the place of each one in it, so a free
+    square is drawn and removed in constant time. The ship slots are the
+    position in the fleet of the ship at each grid position, None for the
+    water, and the hit points the squares of each ship not bombed yet, so
+    a bomb is resolved with a lookup and a decrement. The ships and the hull
+    squares left afloat are counted down as they are bombed"""
+    __slots__ = ('ships', 'bombs', 'sunken_ships', 'ships_masks',
+                 'fleet_mask', 'bombs_mask', 'hits_mask', 'sunken_mask',
+                 'free_squares', 'free_positions', 'ship_slots',
+                 'hit_points', 'ships_left', 'hull_left')
+
+    def __init__(self, ships, bombs=None, sunken_ships=None, ship_slots=None,
+                 hit_points=None, ships_left=None, hull_left=None):
+        self.ships = ships
+        self.bombs = bombs if bombs is not None else []
+        self.sunken_ships = sunken_ships if sunken_ships is not None else []
+        self.ships_masks = [ship.mask for ship in ships]
+        self.fleet_mask = board.union(self.ships_masks)
+        self.bombs_mask = board.squares_mask(
+            bomb.target_square for bomb in self.bombs)
+        self.hits_mask = board.squares_mask(
+            bomb.target_square for bomb in self.bombs if bomb.result == HIT)
+        self.sunken_mask = board.union(
+            self.ships_masks[index] for index in self.sunken_ships)
+        self.free_squares = board.mask_indexes(board.FULL & ~self.bombs_mask)
+        self.free_positions = [None] * (board.GRID_SIZE * board.GRID_SIZE)
+        for position, index in enumerate(self.free_squares):
+            self.free_positions[index] = position
+        self.ship_slots = (ship_slots if ship_slots is not None
+                           else get_ship_slots(self.ships_masks))
+        self.hit_points = (hit_points if hit_points is not None
+                           else [board.count(mask & ~self.bombs_mask)
+                                 for mask in self.ships_masks])
+        self.ships_left = (ships_left if ships_left is not None
+                           else len(ships) - len(self.sunken_ships))
+        self.hull_left = (hull_left if hull_left is not None
+                          else sum(self.hit_points))
+
+    @property
+    def defeated(self):
+        """Returns True if all the ships of the fleet have been sunken"""
+        return not self.ships_left
+
+    def is_bombed(self, square):
+        """Checks if a bomb has already been dropped at a square"""
+        return bool(board.square_mask(square) & self.bombs_mask)
+
+    def random_free_square(self):
+        """Returns a random square where no bomb has been dropped yet"""
+        return board.square_label(random.choice(self.free_squares))
+
+    def _remove_free_square(self, index):
+        """Removes a grid position from the free squares moving the last one
+        to its place"""
+        position = self.free_positions[index]
+        last_index = self.free_squares.pop()
+        if last_index != index:
+            self.free_squares[position] = last_index
+            self.free_positions[last_index] = position
+        self.free_positions[index] = None
+
+    def drop_bomb(self, square):
+        """Drops a bomb at a square of the fleet. If it fills the same square
+        as a ship the result is a 'Hit' otherwise a 'Mis', and the ship is
+        sunken when all its squares have been bombarded. Returns the result
+        and the position of the sunken ship if there is one"""
+        if self.is_bombed(square):
+            raise ValueError('That bomb has already been dropped!')
+
+        bomb_index = board.square_index(square)
+        bomb_mask = board.SQUARE_MASKS[bomb_index]
+        bombed_ship = self.ship_slots[bomb_index]
+        result = MIS if bombed_ship is None else HIT
+
+        self.bombs.append(Bomb(square, result))
+        self.bombs_mask |= bomb_mask
+        self._remove_free_square(bomb_index)
+        if bombed_ship is None:
+            return result, None
+
+        self.hits_mask |= bomb_mask
+        self.hull_left -= 1
+        self.hit_points[bombed_ship] -= 1
+        if self.hit_points[bombed_ship]:
+            return result, None
+
+        self.ships_left -= 1
+        self.ships[bombed_ship].sunken = True
+        self.sunken_ships.append(bombed_ship)
+        self.sunken_mask |= self.ships_masks[bombed_ship]
+        return result, bombed_ship
+
+
+class Target(object):
+    """Targeting state of the opponent against the player's fleet: the grid
+    positions of the hits on ships not sunken yet in the order they were
+    dropped, the orientation inferred from them (VERTICAL, HORIZONTAL or None)
+    and the queue of grid positions to bombard next"""
+    __slots__ = ('hits', 'orientation', 'frontier')
+
+    def __init__(self, hits=None, orientation=None, frontier=None):
+        self.hits = hits if hits is not None else []
+        self.orientation = orientation
+        self.frontier = frontier if frontier is not None else []
+
+
+class Battle(object):
+    """A game between the player and the opponent. The player side is the
+    opponent's fleet attacked by the player bombs and the opponent side is the
+    player's fleet attacked by the opponent bombs. The moves are the side,
+    PLAYER or OPPONENT, and the square of the bombs dropped in the battle in
+    the order they were dropped. The target is the opponent targeting state,
+    None if it has to be worked out from the opponent bombs"""
+    __slots__ = ('player', 'opponent', 'winner', 'moves', 'target')
+
+    def __init__(self, player, opponent, winner=None, target=None):
+        self.player = player
+        self.opponent = opponent
+        self.winner = winner
+        self.moves = []
+        self.target = target
+
+    @classmethod
+    def new_battle(cls, players_ships, opponents_ships):
+        """Returns a battle between two fleets with no bombs dropped"""
+        return cls(Side(opponents_ships), Side(players_ships))
+
+    @property
+    def game_over(self):
+        return self.winner is not None
+
+    def drop_bomb(self, side, square):
+        """Drops a bomb against a side of the battle, checking if it sinks
+        the last ship of the fleet so the game has come to the end. Returns
+        the bomb result"""
+        result, sunken_ship = side.drop_bomb(square)
+        bomber = PLAYER if side is self.player else OPPONENT
+        self.moves.append((bomber, square))
+        if sunken_ship is not None and side.defeated:
+            self.winner = bomber
+        return result
+
+
+def get_ship_slots(ships_masks):
+    """Returns the position in the fleet of the ship at each grid position,
+    None for the squares without a ship"""
+    ship_slots = [None] * (board.GRID_SIZE * board.GRID_SIZE)
+    for slot, mask in enumerate(ships_masks):
+        for index in board.mask_indexes(mask):
+            ship_slots[index] = slot
+    return ship_slots
+
+
+def pack_move(side, square):
+    """Returns the byte of a move in a packed moves log, the bit of the
+    opponent side followed by the 7 bits of the square index"""
+    return chr((OPPONENT_MOVE if side == OPPONENT else 0) |
+               board.square_index(square))
+
+
+def unpack_move(move):
+    """Returns the side and the square of a move of a packed moves log"""
+    move = ord(move)
+    side = OPPONENT if move & OPPONENT_MOVE else PLAYER
+    return side, board.square_label(move & ~OPPONENT_MOVE)
+
+
+def create_fleet(raw_ships):
+    """Validates and returns the ships of a fleet from a raw representation"""
+    return ShipsManager(Ship, raw_ships).create_ships()
+
+
+def generate_fleet():
+    """Returns a random valid fleet"""
+    return ShipsGenerator(Ship).generate_opponents_ships()
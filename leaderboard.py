@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+leaderboard.py: Holds the high score boards snapshots cached in memcache.
+"""
+
+import bisect
+
+from google.appengine.api import memcache
+
+__author__ = 'Andres Anies'
+__email__ = 'andres_anies@hotmail.com'
+
+ALL_TIME = 'all'
+DAILY = 'daily'
+PERIODS = (ALL_TIME, DAILY)
+
+# Number of entries kept by each board
+TOP_K = 100
+CAS_RETRIES = 5
+# The entries added while a board is being rebuilt may be missing from it,
+# so the boards are rebuilt from time to time
+BOARD_EXPIRATION = 60 * 60
+
+
+def board_key(period, day):
+    """Returns the memcache key of the board of a period, the daily boards
+    are kept per day"""
+    if period == DAILY:
+        return 'LEADERBOARD_{}_{}'.format(period, day.isoformat())
+    return 'LEADERBOARD_{}'.format(period)
+
+
+def get_board(period, day, rebuild):
+    """Returns the entries of a board, the best first. Each entry is a tuple
+    of the bombs, the user name and the date of a won game. If the board is
+    not cached it is rebuilt with the given callable, which returns the
+    TOP_K best entries of the period"""
+    key = board_key(period, day)
+    entries = memcache.get(key)
+    if entries is None:
+        entries = rebuild()
+        memcache.add(key, entries, time=BOARD_EXPIRATION)
+    return entries
+
+
+def add_entry(entry, day):
+    """Adds the entry of a won game to the cached boards it qualifies for.
+    Boards that are not cached are left to be rebuilt when read"""
+    client = memcache.Client()
+    for period in PERIODS:
+        key = board_key(period, day)
+        for _ in range(CAS_RETRIES):
+            entries = client.gets(key)
+            if entries is None:
+                break
+            # The ties keep the order of the games
+            position = bisect.bisect_right(
+                [bombs for bombs, _, _ in entries], entry[0])
+            if position >= TOP_K:
+                break
+            entries = (entries[:position] + [entry] + entries[position:])[
+                :TOP_K]
+            if client.cas(key, entries, time=BOARD_EXPIRATION):
+                break
+        else:
+            # Too much contention, the board will be rebuilt when read
+            memcache.delete(key)
@@ -3,27 +3,116 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 
+import json
+import logging
+from datetime import datetime, timedelta
+
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
-from api import SeaBattleApi
-from models import User, Game
+from models import ActiveGamesCounter
+from models import User, Game, Score, UserStats
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        """Starts sending a reminder email to each User with an email about
+        its active games. Called every 3 hours using a cron job"""
+        taskqueue.add(url='/tasks/fan_out_reminders')
+
+
+class FanOutReminders(webapp2.RequestHandler):
+    BATCH_SIZE = 500
+    # Number of players grouped by each task
+    PLAYERS_PER_TASK = 1000
+    # Number of players reminded by each digests task
+    DIGESTS_PER_TASK = 50
+
+    def post(self):
+        """Groups a batch of the active games by player with a projection
+        query and enqueues the tasks which send the reminders of those
+        players. Re-enqueues itself with the cursor of the first game of the
+        next player until every active game has been visited"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        query = Game.query(Game.game_over == False).order(Game.player)
+        iterator = query.iter(projection=[Game.player], start_cursor=cursor,
+                              batch_size=self.BATCH_SIZE,
+                              produce_cursors=True)
+
+        players_games = {}
+        next_cursor = None
+        for game in iterator:
+            # Cut the batch between two players so each one gets a single
+            # reminder with all of its games
+            if len(players_games) >= self.PLAYERS_PER_TASK and \
+                    game.player not in players_games:
+                next_cursor = iterator.cursor_before()
+                break
+            players_games.setdefault(game.player, []).append(
+                game.key.urlsafe())
+
+        digests = [{'user': player.urlsafe(), 'games': games}
+                   for player, games in players_games.items()]
+        tasks = [taskqueue.Task(url='/tasks/send_reminder_digests',
+                                params={'digests': json.dumps(
+                                    digests[index:index +
+                                            self.DIGESTS_PER_TASK])})
+                 for index in range(0, len(digests), self.DIGESTS_PER_TASK)]
+        # The queue takes up to 100 tasks per call
+        for index in range(0, len(tasks), 100):
+            taskqueue.Queue().add(tasks[index:index + 100])
+
+        if next_cursor:
+            taskqueue.add(url='/tasks/fan_out_reminders',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class SendReminderDigests(webapp2.RequestHandler):
+    # Users are not reminded again before this time has passed
+    REMINDER_INTERVAL = timedelta(hours=2)
+
+    def post(self):
+        """Sends each user with an email an only reminder listing its active
+        games, unless it was recently reminded. The users and their games are
+        loaded from the keys of the digests and only the games still active
+        of each user are listed. The users are marked as reminded before the
+        emails are sent, so a retried task won't mail them again"""
+        digests = json.loads(self.request.get('digests'))
+        user_keys = [ndb.Key(urlsafe=digest['user']) for digest in digests]
+        game_keys = [ndb.Key(urlsafe=game) for digest in digests
+                     for game in digest['games']]
+        users = ndb.get_multi([key for key in user_keys
+                               if key.kind() == User._get_kind()])
+        players_games = {}
+        for game in ndb.get_multi([key for key in game_keys
+                                   if key.kind() == Game._get_kind()]):
+            if game and not game.game_over:
+                players_games.setdefault(game.player, []).append(game)
+        now = datetime.now()
+
+        reminders = []
         for user in users:
-            games = Game.query(Game.player == user.key, Game.game_over == False)
-            continue_game_endpoint = "https://{}.appspot.com" \
-                                     "/_ah/api/explorer" \
-                                     "#p/sea_battle/v1/sea_battle.make_move" \
-                                     "?urlsafe_game_key=".format(app_id)
+            if user and user.email and not (
+                    user.last_reminded and
+                    now - user.last_reminded < self.REMINDER_INTERVAL):
+                user_games = players_games.get(user.key)
+                if user_games:
+                    user.last_reminded = now
+                    reminders.append((user, user_games))
+        ndb.put_multi([user for user, _ in reminders])
+
+        app_id = app_identity.get_application_id()
+        continue_game_endpoint = "https://{}.appspot.com" \
+                                 "/_ah/api/explorer" \
+                                 "#p/sea_battle/v1/sea_battle.make_move" \
+                                 "?urlsafe_game_key=".format(app_id)
+        for user, games in reminders:
             games_urls = ['{}{}'.format(continue_game_endpoint,
-                                        game.key.urlsafe()) for game in games]
+                                        game.key.urlsafe())
+                          for game in games]
 
             subject = 'This is a reminder!'
             body = 'Hello {}, you have a pending battle(s)! ' \
@@ -31,21 +120,166 @@ class SendReminderEmail(webapp2.RequestHandler):
                 user.name, ', '.join(games_urls))
             # This will send emails, the arguments to send_mail are:
             # from, to, subject, body
-            if games_urls:
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
+        self.response.set_status(204)
+
+
+class AddActiveGames(webapp2.RequestHandler):
+    def post(self):
+        """Adds the games and bombs enqueued by a game to the active games
+        counters"""
+        ActiveGamesCounter.add(int(self.request.get('games')),
+                               int(self.request.get('bombs')))
+        self.response.set_status(204)
+
+
+class ReconcileActiveGames(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+
+    @staticmethod
+    def enqueue(snapshot, step, params):
+        """Enqueues a step of a recount named after its snapshot, so a
+        retried step can't start a second chain of tasks"""
+        try:
+            taskqueue.add(url='/tasks/reconcile_active_games',
+                          name='reconcile-active-games-{}-{}'.format(
+                              snapshot, step),
+                          params=dict(params, snapshot=snapshot, step=step))
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    def get(self):
+        """Starts recounting the active games and their player bombs taking
+        a snapshot of the counters. Called every day using a cron job"""
+        games, bombs = ActiveGamesCounter.totals()
+        self.enqueue(datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), 0,
+                     {'snapshot_games': games, 'snapshot_bombs': bombs,
+                      'games': 0, 'bombs': 0})
+
+    def post(self):
+        """Recounts a batch of the active games and re-enqueues itself with
+        the query cursor and the partial totals until every active game has
+        been visited. Then adds the difference between the recount and the
+        snapshot of the counters taken when it started, so the drift is
+        corrected while the updates made in the meantime are kept"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games = int(self.request.get('games'))
+        bombs = int(self.request.get('bombs'))
+        active_games, next_cursor, more = Game.query(
+            Game.game_over == False).fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor)
+        games += len(active_games)
+        bombs += sum(len(game.player_bombs) for game in active_games)
+
+        snapshot = self.request.get('snapshot')
+        snapshot_games = int(self.request.get('snapshot_games'))
+        snapshot_bombs = int(self.request.get('snapshot_bombs'))
+        if more and next_cursor:
+            self.enqueue(snapshot, int(self.request.get('step')) + 1,
+                         {'cursor': next_cursor.urlsafe(),
+                          'snapshot_games': snapshot_games,
+                          'snapshot_bombs': snapshot_bombs,
+                          'games': games, 'bombs': bombs})
+        else:
+            ActiveGamesCounter.add_later('reconcile-{}'.format(snapshot),
+                                         games - snapshot_games,
+                                         bombs - snapshot_bombs)
+            logging.info('Active games: %d, bombs: %d', games, bombs)
+        self.response.set_status(204)
+
+
+class MigrateGames(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+
+    def post(self):
+        """Embeds the ships and bombs of the games stored with the old key
+        based layout, each game in its own transaction. Processes a batch of
+        games and re-enqueues itself with the query cursor until every game
+        has been visited"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor)
+        for game in games:
+            if game.legacy_keys:
+                Game.embed_legacy_game(game.key)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_games',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class BackfillUserStats(webapp2.RequestHandler):
+    BATCH_SIZE = 50
+
+    def post(self):
+        """Recounts the wins and loses of the users from their scores. Processes
+        a batch of users and re-enqueues itself with the query cursor until
+        every user has been visited. It can be run again safely as the stats
+        are replaced, not incremented"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor)
+        counts = [(Score.query(Score.user == user.key,
+                               Score.won == True).count_async(),
+                   Score.query(Score.user == user.key,
+                               Score.won == False).count_async())
+                  for user in users]
+        ndb.put_multi([UserStats.new_stats(user, wins.get_result(),
+                                           loses.get_result())
+                       for user, (wins, loses) in zip(users, counts)])
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_user_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class MigrateUsers(webapp2.RequestHandler):
+    BATCH_SIZE = 20
+
+    def post(self):
+        """Moves the users keyed by a numeric id under the key of their
+        normalized names. Processes a batch of users and re-enqueues itself
+        with the query cursor until every user has been visited"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor)
+        for user in users:
+            if user.is_legacy and not user.migrate():
+                logging.warning('User %s not migrated, its name is taken',
+                                user.key.id())
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_users',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
 
+class DeleteFleetPool(webapp2.RequestHandler):
+    BATCH_SIZE = 500
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
     def post(self):
-        """Update game listing announcement in memcache."""
-        SeaBattleApi._cache_average_attempts()
+        """Deletes the opponent fleets stored by the removed fleet pool.
+        Deletes a batch of them and re-enqueues itself until none is left"""
+        keys = ndb.Query(kind='FleetPool').fetch(self.BATCH_SIZE,
+                                                 keys_only=True)
+        ndb.delete_multi(keys)
+        if len(keys) == self.BATCH_SIZE:
+            taskqueue.add(url='/tasks/delete_fleet_pool')
         self.response.set_status(204)
 
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/fan_out_reminders', FanOutReminders),
+    ('/tasks/send_reminder_digests', SendReminderDigests),
+    ('/crons/reconcile_active_games', ReconcileActiveGames),
+    ('/tasks/reconcile_active_games', ReconcileActiveGames),
+    ('/tasks/add_active_games', AddActiveGames),
+    ('/tasks/migrate_games', MigrateGames),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/migrate_users', MigrateUsers),
+    ('/tasks/delete_fleet_pool', DeleteFleetPool),
 ], debug=True)
@@ -2,11 +2,19 @@
 """models.py - This file contains the class definitions for the Datastore
 entities used by the Game."""
 
+import random
 from datetime import date
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from protorpc import messages
 
+import board
+import engine
+import leaderboard
+from bombers import DENSITY_STRATEGY
+from bombers import HUNT_STRATEGY
+from bombers import OPPONENT_BOMBERS
 from ships import ShipsGenerator
 from ships import ShipsManager
 
@@ -15,149 +23,105 @@ __email__ = 'andres_anies@hotmail.com'
 
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile keyed by its normalized name. The users created before
+    are keyed by a numeric id until they are migrated"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
+    last_reminded = ndb.DateTimeProperty(indexed=False)
 
-
-class Ship(ndb.Model):
-    """Ship which forms part of the player or opponent fleet"""
-    BATTLESHIP = 4
-    CRUISER = 3
-    DESTROYER = 2
-    SUBMARINE = 1
-
-    TYPE_CHOICES = [BATTLESHIP, CRUISER, DESTROYER, SUBMARINE]
-
-    TYPE_NAMES = {
-        BATTLESHIP: 'Battleship',
-        CRUISER: 'Cruiser',
-        DESTROYER: 'Destroyer',
-        SUBMARINE: 'Submarine',
-    }
-
-    VERTICAL = 1
-    HORIZONTAL = 2
-    ORIENTATION_CHOICES = [VERTICAL, HORIZONTAL]
-
-    type = ndb.IntegerProperty(required=True, choices=TYPE_CHOICES)
-    star_square = ndb.StringProperty(required=True)
-    orientation = ndb.IntegerProperty(
-        required=True, choices=ORIENTATION_CHOICES)
-    sunken = ndb.BooleanProperty(default=False)
-
-    @classmethod
-    def create_ship(cls, ship_type, star_square, orientation, save=True):
-        """Takes a ship components and returns a saved(optional)
-         instance of the db ship model"""
-        cls.validate_ship(ship_type, star_square, orientation)
-        ship = Ship(type=ship_type, star_square=star_square,
-                    orientation=orientation)
-        if save:
-            ship.put()
-
-        return ship
-
-    @classmethod
-    def validate_ship(cls, ship_type, star_square, orientation):
-        """Validates that the start square fits in the grid and has a correct
-        format, the type value is of a known option and the rest of the
-        squares of the ship fits in the game grid"""
-        try:
-            cls.validate_square(star_square)
-            cls.validate_type(ship_type)
-            cls.check_if_fit_in_grid(ship_type, star_square, orientation)
-        except ValueError as e:
-            raise ValueError('%s for %s at %s' %
-                             (str(e), cls.TYPE_NAMES[ship_type], star_square))
-
-    @classmethod
-    def validate_square(cls, square):
-        """Validates that the start square fits in the grid"""
-        if len(square) > 3:
-            raise ValueError('Invalid square')
-
-        cls._get_row_fow_letter(square[0])
-        square_column = int(square[1:])
-        if square_column not in range(1, 11):
-            raise ValueError('The number of the column must be '
-                             'an integer between 1 to 10')
-
-    @classmethod
-    def _get_row_fow_letter(cls, letter):
-        """Gets a number representation of the row(used for
-        arithmetic operations)"""
-        row_map = {
-            'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5,
-            'F': 6, 'G': 7, 'H': 8, 'I': 9, 'J': 10,
-        }
-        try:
-            return row_map[letter]
-        except KeyError:
-            raise ValueError('The letter of the row must '
-                             'be between A to J uppercase')
-
-    @classmethod
-    def validate_type(cls, ship_type):
-        """Checks if the selected type option is one of the allowed types"""
-        if ship_type not in cls.TYPE_CHOICES:
-            raise ValueError('Invalid ship type, options are: '
-                             '4 for BATTLESHIP, 3 for CRUISER '
-                             '2 for DESTROYER and 1 for SUBMARINE')
-
-    @classmethod
-    def check_if_fit_in_grid(cls, ship_type, start_square, orientation):
-        """Checks if all the squares in the ship fits in the game grid
-        so it's a valid ship"""
-        end_square = cls.get_end_square(ship_type, start_square, orientation)
-        try:
-            cls.validate_square(end_square)
-        except ValueError:
-            raise ValueError("Ship doesn't fit in sea grid")
+    @staticmethod
+    def normalize_name(name):
+        """Returns the key name of the user with the given name"""
+        key_name = (name or '').strip().lower()
+        if not key_name:
+            raise ValueError('A user name is required')
+        return key_name
 
     @classmethod
-    def get_end_square(cls, ship_type, start_square, orientation):
-        """Calculates and returns the last square of a ship"""
-        ship_length = ship_type - 1
-        return cls.get_square_at_relative_position(
-            start_square, orientation, stepped_squares=ship_length)
+    def get_by_name(cls, name):
+        """Returns the user with the given name or None. The user keyed by
+        the normalized name is returned unless its name is not exactly the
+        given one and a user with that name has not been migrated yet, as it
+        couldn't be moved under the same key"""
+        user = cls.get_by_id(cls.normalize_name(name))
+        if not user or user.name != name:
+            user = cls.query(cls.name == name).get() or user
+        return user
 
     @classmethod
-    def get_square_at_relative_position(
-            cls, start_square, orientation, stepped_squares):
-        """Calculates and returns the square of given position of a ship
-        like the second or third, etc"""
-        if orientation == cls.VERTICAL:
-            star_square_row = cls._get_row_fow_letter(start_square[0])
-            end_square_row = star_square_row + stepped_squares
-            end_square_row = chr(64 + end_square_row)
-        else:
-            end_square_row = start_square[0]
-
-        start_square_column = int(start_square[1:])
-        if orientation == cls.HORIZONTAL:
-            end_square_column = start_square_column + stepped_squares
-        else:
-            end_square_column = start_square_column
-
-        return '%s%d' % (end_square_row, end_square_column)
-
-    @property
-    def squares(self):
-        """Calculates and returns all the squares that belong to the ship"""
-        ship_length = self.type
-
-        squares = [self.star_square]
-        for step in range(1, ship_length):
-            relative_square = self.get_square_at_relative_position(
-                self.star_square, self.orientation, stepped_squares=step)
-            squares.append(relative_square)
-        return squares
+    @ndb.transactional(xg=True)
+    def create(cls, name, email=None):
+        """Creates a user along with its empty stats. Returns None if the
+        name is already taken"""
+        key = ndb.Key(cls, cls.normalize_name(name))
+        if key.get():
+            return None
+        user = cls(key=key, name=name, email=email)
+        ndb.put_multi([user, UserStats.new_stats(user)])
+        return user
 
     @property
-    def type_name(self):
-        """Returns a human readable ship type representation"""
-        return self.TYPE_NAMES[self.type]
+    def is_legacy(self):
+        return not isinstance(self.key.id(), basestring)
+
+    def migrate(self):
+        """Moves a user keyed by a numeric id under the key of its normalized
+        name, pointing its games, scores and stats to the new key. A user with
+        exactly the same name already keyed by it is merged with this one.
+        Returns False if the key name is taken by a different name"""
+        user = self._get_or_insert_migrated()
+        if not user:
+            return False
+
+        # The games may be played meanwhile so each one is moved in its own
+        # transaction, the scores are never updated
+        for game_key in Game.query(Game.player == self.key).fetch(
+                keys_only=True):
+            self._move_game(game_key, user.key)
+        scores = Score.query(Score.user == self.key).fetch()
+        for score in scores:
+            score.user = user.key
+        ndb.put_multi(scores)
+        UserStats.merge(self.key, user)
+        self.key.delete()
+        return True
+
+    @ndb.transactional
+    def _move_game(self, game_key, user_key):
+        """Points a game of this user to the given user key"""
+        game = game_key.get()
+        if game and game.player == self.key:
+            game.player = user_key
+            game.put()
+
+    @ndb.transactional
+    def _get_or_insert_migrated(self):
+        """Returns the user keyed by the normalized name of this one,
+        inserting a copy of this user if there is none"""
+        key = ndb.Key(User, self.normalize_name(self.name))
+        user = key.get()
+        if not user:
+            user = User(key=key, name=self.name, email=self.email)
+            user.put()
+        return user if user.name == self.name else None
+
+
+def get_user_names(user_keys):
+    """Returns a dictionary of user keys and their names fetching all the
+    distinct users with a single batch get"""
+    unique_keys = list(set(user_keys))
+    users = ndb.get_multi(unique_keys)
+    return dict((key, user.name)
+                for key, user in zip(unique_keys, users) if user)
+
+
+class Ship(engine.ShipRules, ndb.Model):
+    """Ship which forms part of the player or opponent fleet"""
+    type = ndb.IntegerProperty(required=True, choices=engine.TYPE_CHOICES)
+    star_square = ndb.StringProperty(required=True)
+    orientation = ndb.IntegerProperty(
+        required=True, choices=engine.ORIENTATION_CHOICES)
+    sunken = ndb.BooleanProperty(default=False)
 
     def to_form(self):
         """Returns a ShipForm representation of the Ship"""
@@ -170,10 +134,11 @@ class Ship(ndb.Model):
 
 
 class Bomb(ndb.Model):
-    MIS = 'Mis'
-    HIT = 'Hit'
+    """Bomb dropped by the player or the opponent"""
+    MIS = engine.MIS
+    HIT = engine.HIT
 
-    RESULT_CHOICES = [MIS, HIT]
+    RESULT_CHOICES = engine.RESULT_CHOICES
 
     target_square = ndb.StringProperty(required=True)
     result = ndb.StringProperty(choices=RESULT_CHOICES)
@@ -186,80 +151,610 @@ class Bomb(ndb.Model):
         return form
 
 
+class OpponentTarget(ndb.Model):
+    """Targeting state of the opponent, see engine.Target. The hits and the
+    queued squares are stored as grid positions"""
+    hits = ndb.IntegerProperty(repeated=True)
+    orientation = ndb.IntegerProperty(choices=engine.ORIENTATION_CHOICES)
+    frontier = ndb.IntegerProperty(repeated=True)
+
+
 class Game(ndb.Model):
-    """Game object"""
+    """Game object. The fleets and the dropped bombs are embedded in the
+    entity so a game is loaded and saved with a single datastore operation,
+    the sunken ships are stored as positions of the corresponding fleet.
+    The bombs are stored as a packed log of the moves, one byte per bomb
+    with its side and square, their results are given by the fleets"""
+    HUNT_STRATEGY = HUNT_STRATEGY
+    DENSITY_STRATEGY = DENSITY_STRATEGY
+
+    STRATEGY_CHOICES = sorted(OPPONENT_BOMBERS)
 
     player = ndb.KeyProperty(required=True, kind='User')
-    players_ships = ndb.KeyProperty(kind='Ship', repeated=True)
-    player_bombs = ndb.KeyProperty(kind='Bomb', repeated=True)
-    sunken_players_ships = ndb.KeyProperty(kind='Ship', repeated=True)
-    opponents_ships = ndb.KeyProperty(kind='Ship', repeated=True)
-    opponent_bombs = ndb.KeyProperty(kind='Bomb', repeated=True)
-    sunken_opponents_ships = ndb.KeyProperty(kind='Ship', repeated=True)
+    # Name of the player, so the game forms don't get the user. Missing in
+    # the games created before it was kept
+    player_name = ndb.StringProperty(indexed=False)
+    players_ships = ndb.LocalStructuredProperty(
+        Ship, repeated=True, name='players_fleet')
+    sunken_players_ships = ndb.IntegerProperty(
+        repeated=True, indexed=False, name='sunken_players_fleet')
+    opponents_ships = ndb.LocalStructuredProperty(
+        Ship, repeated=True, name='opponents_fleet')
+    moves = ndb.BlobProperty(default='')
+    sunken_opponents_ships = ndb.IntegerProperty(
+        repeated=True, indexed=False, name='sunken_opponents_fleet')
     game_over = ndb.BooleanProperty(required=True, default=False)
+    opponent_strategy = ndb.StringProperty(
+        choices=STRATEGY_CHOICES, default=HUNT_STRATEGY, indexed=False)
+    # Position in the fleet of the ship at each grid position, a byte per
+    # square, and the squares not bombed yet of each ship of the fleets
+    players_ship_slots = ndb.BlobProperty()
+    players_hit_points = ndb.IntegerProperty(repeated=True, indexed=False)
+    opponents_ship_slots = ndb.BlobProperty()
+    opponents_hit_points = ndb.IntegerProperty(repeated=True, indexed=False)
+    # Ships and hull squares of each fleet not sunken yet, the game is over
+    # when any fleet has no ships left
+    players_ships_left = ndb.IntegerProperty(indexed=False)
+    players_hull_left = ndb.IntegerProperty(indexed=False)
+    opponents_ships_left = ndb.IntegerProperty(indexed=False)
+    opponents_hull_left = ndb.IntegerProperty(indexed=False)
+    # Kept by the opponent strategies that follow the hits on the player's
+    # ships, worked out from the opponent bombs when missing
+    opponent_target = ndb.LocalStructuredProperty(OpponentTarget)
+    # Client supplied id and result message of the last applied move, used
+    # to answer retried moves without playing them again
+    last_move_id = ndb.StringProperty(indexed=False)
+    last_move_message = ndb.StringProperty(indexed=False)
+
+    # References to the Ship and Bomb entities of the games stored before
+    # the fleets and bombs were embedded, only used to migrate them
+    legacy_players_ships = ndb.KeyProperty(
+        kind='Ship', repeated=True, name='players_ships')
+    legacy_player_bombs = ndb.KeyProperty(
+        kind='Bomb', repeated=True, name='player_bombs')
+    legacy_sunken_players_ships = ndb.KeyProperty(
+        kind='Ship', repeated=True, name='sunken_players_ships')
+    legacy_opponents_ships = ndb.KeyProperty(
+        kind='Ship', repeated=True, name='opponents_ships')
+    legacy_opponent_bombs = ndb.KeyProperty(
+        kind='Bomb', repeated=True, name='opponent_bombs')
+    legacy_sunken_opponents_ships = ndb.KeyProperty(
+        kind='Ship', repeated=True, name='sunken_opponents_ships')
+
+    # Ship slot byte of the squares without a ship
+    NO_SHIP = 0xff
 
     @classmethod
-    def new_game(cls, user, raw_ships):
+    def new_game(cls, user, raw_ships, opponent_strategy=None,
+                 user_name=None):
         """Creates and returns a new game"""
+        opponent_strategy = opponent_strategy or cls.HUNT_STRATEGY
+        if opponent_strategy not in cls.STRATEGY_CHOICES:
+            raise ValueError('Invalid opponent strategy, options are: %s' %
+                             ', '.join(cls.STRATEGY_CHOICES))
+
         ships = ShipsManager(Ship, raw_ships).create_ships()
-        game = Game(player=user, players_ships=ships,
-                    opponents_ships=ShipsGenerator(
-                        Ship).generate_opponents_ships())
-        game.put()
+        opponents_ships = ShipsGenerator(Ship).generate_opponents_ships()
+        game = Game(player=user, player_name=user_name, players_ships=ships,
+                    opponents_ships=opponents_ships,
+                    opponent_strategy=opponent_strategy)
+        game._store_fleets_state(game.to_battle())
+        game.put_counted(games=1)
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    @property
+    def legacy_keys(self):
+        """Keys of the Ship and Bomb entities of a game stored with the old
+        key based layout"""
+        return list(set(self.legacy_players_ships +
+                        self.legacy_opponents_ships +
+                        self.legacy_player_bombs +
+                        self.legacy_opponent_bombs))
+
+    @staticmethod
+    @ndb.non_transactional
+    def _get_legacy_entities(keys):
+        """Returns the entities of the given keys by key. They are read
+        outside of any transaction as each one is in its own entity group"""
+        return dict(zip(keys, ndb.get_multi(keys)))
+
+    @classmethod
+    @ndb.transactional
+    def embed_legacy_game(cls, key):
+        """Gets a game and embeds its legacy ships and bombs inside a
+        transaction, so the moves or migrations committed since the game was
+        read are not overwritten. The old Ship and Bomb entities are deleted
+        once the game is committed. Returns the game or None if it doesn't
+        exist"""
+        game = key.get()
+        if game:
+            legacy_keys = game.legacy_keys
+            if game.embed_legacy_entities():
+                game.put()
+                ndb.get_context().call_on_commit(
+                    lambda: ndb.delete_multi(legacy_keys))
+        return game
+
+    def embed_legacy_entities(self):
+        """Copies the ships of a game stored with the old key based layout
+        into the game itself and packs its bombs into the moves log, fetching
+        them in a single batch. Returns True if the game was migrated and
+        needs to be saved"""
+        legacy_keys = self.legacy_keys
+        if not legacy_keys:
+            return False
+
+        entities = self._get_legacy_entities(legacy_keys)
+
+        def found(keys):
+            return [key for key in keys if entities[key] is not None]
+
+        def embed(model, keys):
+            return [model(**entities[key].to_dict()) for key in found(keys)]
+
+        # The sunken ships are positions of the fleets without the missing
+        # ships
+        players_ships_keys = found(self.legacy_players_ships)
+        opponents_ships_keys = found(self.legacy_opponents_ships)
+        self.players_ships = embed(Ship, players_ships_keys)
+        self.opponents_ships = embed(Ship, opponents_ships_keys)
+        self.sunken_players_ships = [
+            players_ships_keys.index(key)
+            for key in self.legacy_sunken_players_ships
+            if key in players_ships_keys]
+        self.sunken_opponents_ships = [
+            opponents_ships_keys.index(key)
+            for key in self.legacy_sunken_opponents_ships
+            if key in opponents_ships_keys]
+
+        for ships, sunken_ships in [
+                (self.players_ships, self.sunken_players_ships),
+                (self.opponents_ships, self.sunken_opponents_ships)]:
+            for index in sunken_ships:
+                ships[index].sunken = True
+
+        # The bombs are packed in the order given by the turns: the player
+        # bombs until it misses, then the opponent bombs until it misses and
+        # so on
+        bombs = {engine.PLAYER: [entities[key] for key
+                                 in found(self.legacy_player_bombs)],
+                 engine.OPPONENT: [entities[key] for key
+                                   in found(self.legacy_opponent_bombs)]}
+        dropped = {engine.PLAYER: 0, engine.OPPONENT: 0}
+        other_side = {engine.PLAYER: engine.OPPONENT,
+                      engine.OPPONENT: engine.PLAYER}
+        side = engine.PLAYER
+        for _ in range(len(bombs[engine.PLAYER]) +
+                       len(bombs[engine.OPPONENT])):
+            if dropped[side] == len(bombs[side]):
+                side = other_side[side]
+            bomb = bombs[side][dropped[side]]
+            dropped[side] += 1
+            self.add_move(side, bomb.target_square)
+            if bomb.result != Bomb.HIT:
+                side = other_side[side]
+
+        self.legacy_players_ships = []
+        self.legacy_opponents_ships = []
+        self.legacy_player_bombs = []
+        self.legacy_opponent_bombs = []
+        self.legacy_sunken_players_ships = []
+        self.legacy_sunken_opponents_ships = []
+        return True
+
+    def add_move(self, side, square):
+        """Appends a bomb of a side, engine.PLAYER or engine.OPPONENT, to the
+        moves log"""
+        self.moves += engine.pack_move(side, square)
+
+    def get_moves(self):
+        """Returns the side and the square of each bomb of the game in the
+        order they were dropped"""
+        return [engine.unpack_move(move) for move in self.moves]
+
+    def _get_bombs(self, bomber, ships, moves=None):
+        """Returns the Bombs dropped by a side against a fleet, from the
+        given moves if already unpacked"""
+        if moves is None:
+            moves = self.get_moves()
+        fleet_mask = board.union(ship.mask for ship in ships)
+        return [Bomb(target_square=square,
+                     result=(Bomb.HIT if board.square_mask(square) &
+                             fleet_mask else Bomb.MIS))
+                for side, square in moves if side == bomber]
+
+    @property
+    def player_bombs(self):
+        return self._get_bombs(engine.PLAYER, self.opponents_ships)
+
+    @property
+    def opponent_bombs(self):
+        return self._get_bombs(engine.OPPONENT, self.players_ships)
+
+    @classmethod
+    def to_forms(cls, games, message):
+        """Returns the GameForm representations of a list of games resolving
+        all of their players at once"""
+        user_names = get_user_names([game.player for game in games])
+        return [game.to_form(message, user_names.get(game.player))
+                for game in games]
+
+    def to_battle(self):
+        """Returns the engine representation of the game to be played"""
+        def to_side(ships, bombs, sunken_ships, ship_slots, hit_points,
+                    ships_left, hull_left):
+            return engine.Side(
+                [engine.Ship(ship.type, ship.star_square, ship.orientation,
+                             ship.sunken) for ship in ships],
+                [engine.Bomb(bomb.target_square, bomb.result)
+                 for bomb in bombs],
+                list(sunken_ships),
+                self.unpack_ship_slots(ship_slots) if ship_slots else None,
+                list(hit_points) if hit_points else None,
+                ships_left, hull_left)
+
+        target = None
+        if self.opponent_target is not None:
+            target = engine.Target(list(self.opponent_target.hits),
+                                   self.opponent_target.orientation,
+                                   list(self.opponent_target.frontier))
+
+        battle = engine.Battle(
+            to_side(self.opponents_ships, self.player_bombs,
+                    self.sunken_opponents_ships, self.opponents_ship_slots,
+                    self.opponents_hit_points, self.opponents_ships_left,
+                    self.opponents_hull_left),
+            to_side(self.players_ships, self.opponent_bombs,
+                    self.sunken_players_ships, self.players_ship_slots,
+                    self.players_hit_points, self.players_ships_left,
+                    self.players_hull_left),
+            target=target)
+        if self.game_over:
+            battle.winner = (engine.PLAYER if battle.player.defeated
+                             else engine.OPPONENT)
+        return battle
+
+    def save_battle(self, battle):
+        """Stores the bombs dropped and the ships sunken in a battle returned
+        by to_battle and saves the game, along with its score if the battle
+        has come to the end"""
+        counted_bombs = len(self.player_bombs)
+        for side, square in battle.moves:
+            self.add_move(side, square)
+
+        for ships, side in [(self.opponents_ships, battle.player),
+                            (self.players_ships, battle.opponent)]:
+            for index in side.sunken_ships:
+                ships[index].sunken = True
+        self.sunken_opponents_ships = list(battle.player.sunken_ships)
+        self.sunken_players_ships = list(battle.opponent.sunken_ships)
+        self._store_fleets_state(battle)
+        if battle.target is not None:
+            self.opponent_target = OpponentTarget(
+                hits=battle.target.hits,
+                orientation=battle.target.orientation,
+                frontier=battle.target.frontier)
+
+        if battle.game_over and not self.game_over:
+            self.end_game(won=battle.winner == engine.PLAYER,
+                          counted_bombs=counted_bombs)
+        else:
+            self.put_counted(bombs=len(self.player_bombs) - counted_bombs)
+
+    def _store_fleets_state(self, battle):
+        """Stores the ship slots, which never change, the hit points and the
+        ships and hull squares left of both fleets of a battle returned by
+        to_battle"""
+        if not self.opponents_ship_slots:
+            self.opponents_ship_slots = self.pack_ship_slots(
+                battle.player.ship_slots)
+            self.players_ship_slots = self.pack_ship_slots(
+                battle.opponent.ship_slots)
+        self.opponents_hit_points = battle.player.hit_points
+        self.players_hit_points = battle.opponent.hit_points
+        self.opponents_ships_left = battle.player.ships_left
+        self.opponents_hull_left = battle.player.hull_left
+        self.players_ships_left = battle.opponent.ships_left
+        self.players_hull_left = battle.opponent.hull_left
+
+    @classmethod
+    def pack_ship_slots(cls, ship_slots):
+        """Returns the byte string representation of the ship slots of a
+        fleet"""
+        return ''.join(chr(cls.NO_SHIP if slot is None else slot)
+                       for slot in ship_slots)
+
+    @classmethod
+    def unpack_ship_slots(cls, packed_ship_slots):
+        """Returns the ship slots of a fleet from its byte string
+        representation"""
+        return [None if slot == cls.NO_SHIP else slot
+                for slot in bytearray(packed_ship_slots)]
+
+    @ndb.transactional
+    def put_counted(self, games=0, bombs=0):
+        """Saves the game adding the given number of games and player bombs
+        to the active games counters once the game is committed"""
+        self.put()
+        ActiveGamesCounter.add_later(self._counters_update(self.move_count),
+                                     games, bombs)
+
+    @ndb.transactional
+    def cancel(self):
+        """Removes the game from the database and its player bombs from the
+        active games counters. Returns False if the game was already over or
+        removed"""
+        game = self.key.get()
+        if not game or game.game_over:
+            return False
+        ActiveGamesCounter.add_later(game._counters_update('end'),
+                                     -1, -len(game.player_bombs))
+        game.key.delete()
+        return True
+
+    @property
+    def move_count(self):
+        return len(self.moves)
+
+    def _counters_update(self, step):
+        """Returns the name of the active games counters update of the game
+        at a step, its move count or 'end' once it is over or cancelled"""
+        return 'game-{}-{}'.format(self.key.urlsafe(), step)
+
+    def to_form(self, message, user_name=None, known_moves=None):
+        """Returns a GameForm representation of the Game. If the number of
+        moves known by the client is given only the bombs dropped and the
+        ships sunken after them are included, without the player's ships"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.player.get().name
-        form.players_ships = [ship.get().to_form()
-                              for ship in self.players_ships]
-        form.player_bombs = [bomb.get().to_form()
-                             for bomb in self.player_bombs]
-        form.sunken_players_ships = [ship.get().to_form()
-                                     for ship in self.sunken_players_ships]
-        form.opponent_bombs = [bomb.get().to_form()
-                               for bomb in self.opponent_bombs]
-        form.sunken_opponents_ships = [ship.get().to_form()
-                                       for ship in self.sunken_opponents_ships]
+        form.user_name = (user_name or self.player_name or
+                          self.player.get().name)
         form.game_over = self.game_over
         form.message = message
+        form.move_count = self.move_count
+        form.players_ships_left = self.players_ships_left
+        if form.players_ships_left is None:
+            form.players_ships_left = (len(self.players_ships) -
+                                       len(self.sunken_players_ships))
+        form.opponents_ships_left = self.opponents_ships_left
+        if form.opponents_ships_left is None:
+            form.opponents_ships_left = (len(self.opponents_ships) -
+                                         len(self.sunken_opponents_ships))
+
+        # The moves log is unpacked and resolved once for the whole form
+        moves = self.get_moves()
+        player_bombs = self._get_bombs(engine.PLAYER, self.opponents_ships,
+                                       moves)
+        opponent_bombs = self._get_bombs(engine.OPPONENT, self.players_ships,
+                                         moves)
+        known_player_bombs = known_opponent_bombs = 0
+        if known_moves is not None:
+            form.delta = True
+            known_order = [side for side, _ in moves[:max(known_moves, 0)]]
+            known_player_bombs = known_order.count(engine.PLAYER)
+            known_opponent_bombs = len(known_order) - known_player_bombs
+        else:
+            form.delta = False
+            form.players_ships = [ship.to_form()
+                                  for ship in self.players_ships]
+
+        form.player_bombs = [bomb.to_form() for bomb
+                             in player_bombs[known_player_bombs:]]
+        form.sunken_opponents_ships = self._sunken_ships_forms(
+            self.opponents_ships, self.sunken_opponents_ships,
+            player_bombs[:known_player_bombs])
+        form.opponent_bombs = [bomb.to_form() for bomb
+                               in opponent_bombs[known_opponent_bombs:]]
+        form.sunken_players_ships = self._sunken_ships_forms(
+            self.players_ships, self.sunken_players_ships,
+            opponent_bombs[:known_opponent_bombs])
         return form
 
-    def to_history_form(self):
-        """Returns a GameHistoryForm representation of the Game"""
+    @staticmethod
+    def _sunken_ships_forms(ships, sunken_ships, known_bombs):
+        """Returns the ShipForms of the sunken ships which were not already
+        sunken by the known bombs"""
+        known_mask = board.squares_mask(
+            [bomb.target_square for bomb in known_bombs])
+        return [ships[index].to_form() for index in sunken_ships
+                if ships[index].mask & ~known_mask]
+
+    def to_history_form(self, encoded=False):
+        """Returns a GameHistoryForm representation of the Game, with the
+        packed moves log in place of the bombs lists if encoded"""
         form = GameHistoryForm()
-        form.players_ships = [ship.get().to_form()
-                              for ship in self.players_ships]
-        form.player_bombs = [bomb.get().to_form()
-                             for bomb in self.player_bombs]
-        form.opponent_bombs = [bomb.get().to_form()
-                               for bomb in self.opponent_bombs]
+        form.players_ships = [ship.to_form() for ship in self.players_ships]
+        if encoded:
+            form.encoded_moves = self.moves
+        else:
+            form.player_bombs = [bomb.to_form()
+                                 for bomb in self.player_bombs]
+            form.opponent_bombs = [bomb.to_form()
+                                   for bomb in self.opponent_bombs]
         return form
 
-    def end_game(self, won=False):
+    @ndb.transactional(xg=True)
+    def end_game(self, won=False, counted_bombs=None):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. The game, its score and the player stats are saved
+        in the same transaction that enqueues the removal of the game and
+        its counted_bombs, all of its player bombs by default, from the
+        active games counters"""
+        if counted_bombs is None:
+            counted_bombs = len(self.player_bombs)
+        ActiveGamesCounter.add_later(self._counters_update('end'),
+                                     -1, -counted_bombs)
         self.game_over = True
-        self.put()
         # Add the game to the score 'board'
-        score = Score(user=self.player, date=date.today(), won=won,
+        stats = UserStats.get_or_new(self.player)
+        score = Score(user=self.player, user_name=stats.name,
+                      date=date.today(), won=won,
                       bombs=len(self.player_bombs))
-        score.put()
+        stats.add_result(won)
+        ndb.put_multi([self, score, stats])
+        if won:
+            ndb.get_context().call_on_commit(
+                lambda: leaderboard.add_entry(score.get_leaderboard_entry(),
+                                              score.date))
 
 
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(indexed=False)
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     bombs = ndb.IntegerProperty(required=True)
 
-    def to_form(self):
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns the ScoreForm representations of a list of scores resolving
+        at once the users of the scores saved without their names"""
+        user_names = get_user_names([score.user for score in scores
+                                     if not score.user_name])
+        return [score.to_form(user_names.get(score.user)) for score in scores]
+
+    @classmethod
+    def get_high_scores(cls, period=leaderboard.ALL_TIME, limit=None):
+        """Returns the ScoreForms of the won games of a period with the fewer
+        bombs, up to leaderboard.TOP_K, from the cached board of the period"""
+        if period not in leaderboard.PERIODS:
+            raise ValueError('Invalid period, options are: %s' %
+                             ', '.join(leaderboard.PERIODS))
+
+        today = date.today()
+
+        def rebuild():
+            query = cls.query(cls.won == True)
+            if period == leaderboard.DAILY:
+                query = query.filter(cls.date == today)
+            scores = query.order(cls.bombs).fetch(leaderboard.TOP_K)
+            user_names = get_user_names([score.user for score in scores
+                                         if not score.user_name])
+            return [score.get_leaderboard_entry(user_names.get(score.user))
+                    for score in scores]
+
+        entries = leaderboard.get_board(period, today, rebuild)
+        return [ScoreForm(user_name=user_name, date=score_date, won=True,
+                          bombs=bombs)
+                for bombs, user_name, score_date in entries[:limit]]
+
+    def get_leaderboard_entry(self, user_name=None):
+        """Returns the entry of the Score in the high score boards"""
+        user_name = user_name or self.user_name or self.user.get().name
+        return self.bombs, user_name, str(self.date)
+
+    def to_form(self, user_name=None):
         """Returns a ScoreForm representation of the Score"""
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
-                         date=str(self.date), bombs=self.bombs)
+        return ScoreForm(user_name=(user_name or self.user_name or
+                                    self.user.get().name),
+                         won=self.won, date=str(self.date), bombs=self.bombs)
+
+
+class UserStats(ndb.Model):
+    """Wins and loses of a user, keyed by the id of the user and updated as
+    its games end, so the users can be ranked with a single query"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    name = ndb.StringProperty(required=True, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    loses = ndb.IntegerProperty(default=0, indexed=False)
+    performance = ndb.FloatProperty(default=0.0)
+
+    @classmethod
+    def get_or_new(cls, user_key):
+        """Returns the stats of a user, new empty ones if it has none"""
+        stats = ndb.Key(cls, user_key.id()).get()
+        if not stats:
+            stats = cls.new_stats(user_key.get())
+        return stats
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def merge(cls, user_key, user):
+        """Adds the stats of a user key to the stats of another user and
+        removes them"""
+        stats = ndb.Key(cls, user_key.id()).get()
+        if stats:
+            merged_stats = cls.get_or_new(user.key)
+            merged_stats.wins += stats.wins
+            merged_stats.loses += stats.loses
+            merged_stats.put()
+            stats.key.delete()
+
+    @classmethod
+    def new_stats(cls, user, wins=0, loses=0):
+        """Returns new stats of the user with the given results"""
+        return cls(id=user.key.id(), user=user.key, name=user.name,
+                   wins=wins, loses=loses)
+
+    def add_result(self, won):
+        """Counts a finished game of the user"""
+        if won:
+            self.wins += 1
+        else:
+            self.loses += 1
+
+    def _pre_put_hook(self):
+        self.performance = self.wins / (self.loses + 1.0)
+
+    def to_form(self):
+        """Returns a UserRankingForm representation of the UserStats"""
+        return UserRankingForm(name=self.name, performance=self.performance)
+
+
+class ActiveGamesCounter(ndb.Model):
+    """Shard of the running number of active games and of the bombs dropped
+    by their players. The updates are spread across the shards to avoid
+    contention, and the totals are the sum of all of them. The games
+    enqueue their updates in tasks so the shards are never written by the
+    transactions of the moves"""
+    NUM_SHARDS = 20
+
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    bombs = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def shard_keys(cls):
+        return [ndb.Key(cls, 'shard-%d' % shard)
+                for shard in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    @ndb.transactional
+    def add(cls, games=0, bombs=0):
+        """Adds the given number of games and bombs to a random shard"""
+        key = random.choice(cls.shard_keys())
+        counter = key.get() or cls(key=key)
+        counter.games += games
+        counter.bombs += bombs
+        counter.put()
+
+    @staticmethod
+    def add_later(update, games=0, bombs=0):
+        """Enqueues a task which adds the given number of games and bombs to
+        the counters, named after the update so a repeated update is
+        rejected. Inside a transaction the task is enqueued once the
+        transaction commits, as named tasks can't be transactional, and the
+        updates lost in between are corrected by the reconcile"""
+        if not (games or bombs):
+            return
+
+        def enqueue():
+            try:
+                taskqueue.add(url='/tasks/add_active_games',
+                              name='active-games-{}'.format(update),
+                              params={'games': games, 'bombs': bombs})
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                pass
+        ndb.get_context().call_on_commit(enqueue)
+
+    @classmethod
+    def totals(cls):
+        """Returns the total number of active games and of their bombs"""
+        counters = [counter for counter in ndb.get_multi(cls.shard_keys())
+                    if counter]
+        return (sum(counter.games for counter in counters),
+                sum(counter.bombs for counter in counters))
 
 
 class BombForm(messages.Message):
@@ -294,6 +789,10 @@ class GameForm(messages.Message):
     game_over = messages.BooleanField(7, required=True)
     message = messages.StringField(8, required=True)
     user_name = messages.StringField(9, required=True)
+    move_count = messages.IntegerField(10)
+    delta = messages.BooleanField(11)
+    players_ships_left = messages.IntegerField(12)
+    opponents_ships_left = messages.IntegerField(13)
 
 
 class GameForms(messages.Message):
@@ -306,17 +805,43 @@ class GameHistoryForm(messages.Message):
     players_ships = messages.MessageField(ShipForm, 2, repeated=True)
     player_bombs = messages.MessageField(BombForm, 3, repeated=True)
     opponent_bombs = messages.MessageField(BombForm, 5, repeated=True)
+    encoded_moves = messages.BytesField(6)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
     ships = messages.MessageField(NewShipForm, 2, repeated=True)
+    opponent_strategy = messages.StringField(3)
 
 
 class MakeMoveForm(messages.Message):
-    """Used to make a move in an existing game"""
+    """Used to make a move in an existing game. An optional unique move_id
+    makes the retries of the same move return its stored result, and the
+    optional number of moves known by the client makes the response include
+    only the newer ones"""
     bomb = messages.StringField(1, required=True)
+    move_id = messages.StringField(2)
+    known_moves = messages.IntegerField(3)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make a list of moves in a row in an existing game"""
+    bombs = messages.StringField(1, repeated=True)
+    known_moves = messages.IntegerField(2)
+
+
+class MoveResultForm(messages.Message):
+    """Result of a bomb of a list of moves, or the error which stopped them"""
+    bomb = messages.StringField(1, required=True)
+    result = messages.StringField(2)
+    error = messages.StringField(3)
+
+
+class MovesResultForm(messages.Message):
+    """Results of a list of moves along with the new game state"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
 
 
 class ScoreForm(messages.Message):
@@ -330,6 +855,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class UserRankingForm(messages.Message):
@@ -342,6 +868,7 @@ class UserRankingForm(messages.Message):
 class RankingForms(messages.Message):
     """Return multiple UserRankingForm"""
     items = messages.MessageField(UserRankingForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -6,6 +6,8 @@ ships.py: Holds validators and generators of ships.
 import random
 from collections import Counter
 
+import board
+
 __author__ = 'Andres Anies'
 __email__ = 'andres_anies@hotmail.com'
 
@@ -13,38 +15,83 @@ __email__ = 'andres_anies@hotmail.com'
 class ShipsManager(object):
     """Manages the validation and creation of ships model instances"""
 
-    def __init__(self, ship_model, raw_ships):
+    def __init__(self, ship_model, raw_ships, allow_adjacent=True):
         self.ship_model = ship_model
         self.raw_ships = raw_ships
+        self.allow_adjacent = allow_adjacent
         self.ships = []
 
     def create_ships(self):
-        """Creates a list of ships model instances from a raw representation"""
-        self.check_number_of_ships_by_type()
+        """Creates a list of ships model instances from a raw representation,
+        they aren't saved so they can be embedded in a game. The fleet is
+        validated in a single pass projecting the ships onto an occupancy
+        grid, and all of its errors are reported together"""
+        errors = self.get_number_of_ships_errors()
+        # Position of the ship which fills each square of the grid
+        occupancy = [None] * (board.GRID_SIZE * board.GRID_SIZE)
         for ship in self.raw_ships:
-            ship_instance = self.ship_model.create_ship(
-                ship.type, ship.star_square, ship.orientation, save=False)
+            try:
+                ship_instance = self.ship_model.create_ship(
+                    ship.type, ship.star_square, ship.orientation)
+            except ValueError as e:
+                errors.append(str(e))
+                continue
+            errors.extend(self.place_ship(ship_instance, occupancy))
             self.ships.append(ship_instance)
-        self.check_overlapping_ships()
-        return self.save_ships()
 
-    def check_number_of_ships_by_type(self):
-        """Checks if we have the appropriate number of ships per type"""
+        if errors:
+            raise ValueError('; '.join(errors))
+        return self.ships
+
+    def place_ship(self, ship, occupancy):
+        """Fills the squares of a ship in the occupancy grid. Returns the
+        errors of the ships already placed which overlap it or, if they are
+        not allowed, touch it"""
+        errors = []
+        position = len(self.ships)
+        reported = set()
+        for index in board.mask_indexes(ship.mask):
+            owner = occupancy[index]
+            if owner is None:
+                occupancy[index] = position
+            elif owner not in reported:
+                reported.add(owner)
+                errors.append('%s overlapping %s at %s' % (
+                    self.ships[owner].type_name, ship.type_name,
+                    board.square_label(index)))
+
+        if not self.allow_adjacent:
+            for index in board.mask_indexes(board.neighbours_mask(ship.mask)):
+                owner = occupancy[index]
+                if owner not in (None, position) and owner not in reported:
+                    reported.add(owner)
+                    errors.append('%s next to %s at %s' % (
+                        self.ships[owner].type_name, ship.type_name,
+                        board.square_label(index)))
+        return errors
+
+    def get_number_of_ships_errors(self):
+        """Returns the errors of the number of ships per type"""
         ships_types = [ship.type for ship in self.raw_ships]
         ships_types_count = dict(Counter(ships_types))
 
         if len(ships_types_count) > 4:
-            raise ValueError('Too many ships')
+            return ['Too many ships']
         elif len(ships_types_count) < 4:
-            raise ValueError('Too few ships')
+            return ['Too few ships']
 
-        for ship_type, count in ships_types_count.items():
+        errors = []
+        for ship_type, count in sorted(ships_types_count.items(),
+                                       reverse=True):
+            if ship_type not in self.number_of_ships_by_type:
+                continue
             if count > self.number_of_ships_by_type[ship_type]:
-                raise ValueError(
+                errors.append(
                     'Too many %ss' % self.ship_model.TYPE_NAMES[ship_type])
             elif count < self.number_of_ships_by_type[ship_type]:
-                raise ValueError(
+                errors.append(
                     'Too few %ss' % self.ship_model.TYPE_NAMES[ship_type])
+        return errors
 
     @property
     def number_of_ships_by_type(self):
@@ -57,103 +104,66 @@ class ShipsManager(object):
             self.ship_model.SUBMARINE: 4
         }
 
-    def check_overlapping_ships(self):
-        """Checks if there is any ship which whose squares fills the
-        same space in the grid of other ship"""
-        for test_ship in self.ships:
-            self.check_overlapping_ship(test_ship)
-
-    def check_overlapping_ship(self, test_ship):
-        """Checks for a given ship if overlaps any other ship"""
-        for ship in self.ships:
-            if ship != test_ship:
-                for square in test_ship.squares:
-                    if square in ship.squares:
-                        raise ValueError('%s overlapping %s at %s' % (
-                            test_ship.type_name, ship.type_name, square))
-
-    def save_ships(self):
-        """Saves the created and validated ships into the database
-        and returns a list of its keys"""
-        saved_ships_keys = []
-        for ship in self.ships:
-            ship.put()
-            saved_ships_keys.append(ship.key)
-
-        return saved_ships_keys
-
 
 class ShipsGenerator(ShipsManager):
     """Generates a list of ships randomly for the opponent"""
 
+    # Upper bound of placements tried while searching a fleet, every try
+    # filters at most the 180 placements of a ship type
+    MAX_PLACEMENT_TRIES = 1000
+
     def __init__(self, ship_model):
         super(ShipsManager, self).__init__()
         self.ship_model = ship_model
         self.ships = []
 
     def generate_opponents_ships(self):
-        """Generates randomly a valid fleet of ships that fit in the game grid"""
-        for ship_type in self.ship_model.TYPE_CHOICES:
-            for _ in range(self.number_of_ships_by_type[ship_type]):
-                orientation = random.randint(
-                    1, len(self.ship_model.ORIENTATION_CHOICES))
-                grid_boundaries = self.generate_restricted_grid_boundaries(
-                    ship_type, orientation)
-
-                ship = None
-                while True:
-                    try:
-                        ship = self.generate_ship(
-                            grid_boundaries, ship_type, orientation)
-                        self.check_overlapping_ship(ship)
-                        self.check_nearby_ships(ship)
-                        break
-                    except ValueError:
-                        continue
-
-                self.ships.append(ship)
-        return self.save_ships()
-
-    def generate_restricted_grid_boundaries(self, ship_type, orientation):
-        """Returns the valid boundaries in which can be placed the start square
-        of a given type of ship"""
-        row_limit = 10
-        column_limit = 10
-
-        if orientation == self.ship_model.VERTICAL:
-            row_limit -= (ship_type - 1)
-
-        if orientation == self.ship_model.HORIZONTAL:
-            column_limit = 10 - (ship_type - 1)
-
-        return [row_limit, column_limit]
-
-    def generate_ship(self, grid_boundaries, ship_type, orientation):
-        """Generates a random start square for a ship inside the game grid
-        and returns a not saved ship model instance"""
-        row_limit, column_limit = grid_boundaries[0], grid_boundaries[1]
-
-        row = chr(64 + random.randint(1, row_limit))
-        column = random.randint(1, column_limit)
-
-        star_square = "%s%d" % (row, column)
-
-        return self.ship_model.create_ship(
-            ship_type, star_square, orientation, save=False)
-
-    def check_nearby_ships(self, test_ship):
-        """Checks if there is any ship that has a square at the top, bottom,
-        left or right of a test ship"""
-        for ship in self.ships:
-            for test_square in test_ship.squares:
-                nearby_rows = [ord(test_square[0]) - 1, ord(test_square[0]) + 1]
-                nearby_columns = [
-                    int(test_square[1:]) - 1, int(test_square[1:]) + 1]
-                for square in ship.squares:
-                    is_in_the_same_row = square[0] == test_square[0]
-                    is_in_the_same_column = square[1:] == test_square[1:]
-                    if (ord(square[0]) in nearby_rows and
-                            is_in_the_same_column) or \
-                            (int(square[1:]) in nearby_columns and
-                                 is_in_the_same_row):
-                        raise ValueError()
+        """Generates randomly a valid fleet of ships that fit in the game grid.
+        The ships are placed from the biggest to the smallest, each one at a
+        placement sampled uniformly among the ones which don't overlap or
+        touch the ships already placed"""
+        ships_types = [ship_type
+                       for ship_type in sorted(self.ship_model.TYPE_CHOICES,
+                                               reverse=True)
+                       for _ in range(self.number_of_ships_by_type[ship_type])]
+
+        for ship_type, (_, start_index, vertical, _) in zip(
+                ships_types, self.place_ships(ships_types)):
+            orientation = (self.ship_model.VERTICAL if vertical
+                           else self.ship_model.HORIZONTAL)
+            self.ships.append(self.ship_model(
+                type=ship_type, star_square=board.square_label(start_index),
+                orientation=orientation))
+        return self.ships
+
+    def place_ships(self, ships_types):
+        """Searches with backtracking a placement for each one of the given
+        types of ships so that no ship overlaps or touches another one.
+        Raises a ValueError if no fleet is found in MAX_PLACEMENT_TRIES"""
+        tries = [0]
+
+        def place(position, blocked_mask):
+            if position == len(ships_types):
+                return []
+
+            free_placements = [
+                placement
+                for placement in board.placements(ships_types[position])
+                if not placement[0] & blocked_mask]
+            random.shuffle(free_placements)
+
+            for placement in free_placements:
+                tries[0] += 1
+                if tries[0] > self.MAX_PLACEMENT_TRIES:
+                    raise ValueError('Unable to place the opponent fleet')
+
+                ship_mask = placement[0]
+                placed = place(position + 1, blocked_mask | ship_mask |
+                               board.neighbours_mask(ship_mask))
+                if placed is not None:
+                    return [placement] + placed
+
+        placed_ships = place(0, board.EMPTY)
+        if placed_ships is None:
+            raise ValueError('Unable to place the opponent fleet')
+        return placed_ships
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+simulate.py: Plays opponent AI games offline with the game engine, spread
+across a pool of processes. Reports the distribution of the shots needed to
+sink a fleet, the games per second and the latency percentiles of the
+opponent moves, so the bombing strategies can be compared and their
+performance regressions caught before deploying.
+
+Usage:
+    python simulate.py --games 1000000 --strategy density
+    python simulate.py --fleet test_data/new_game.json --max-p99 500
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import timeit
+from collections import Counter
+from collections import namedtuple
+
+import engine
+from bombers import OPPONENT_BOMBERS
+
+__author__ = 'Andres Anies'
+__email__ = 'andres_anies@hotmail.com'
+
+RawShip = namedtuple('RawShip', ['type', 'star_square', 'orientation'])
+
+# Games played by a process before reporting back its partial results
+CHUNK_SIZE = 1000
+
+
+def load_fleet(path):
+    """Returns the raw ships of a new game request stored in a json file"""
+    with open(path) as fleet_file:
+        ships = json.load(fleet_file)['ships']
+    return [RawShip(int(ship['type']), ship['star_square'],
+                    int(ship['orientation'])) for ship in ships]
+
+
+def play_games(job):
+    """Plays a number of games of an opponent strategy against random fleets
+    or a scripted one. Returns a Counter of the shots needed to sink the
+    fleets, a Counter of the moves latencies in microseconds and the
+    elapsed seconds"""
+    strategy, games, raw_fleet, seed = job
+    random.seed(seed)
+    bomber_class = OPPONENT_BOMBERS[strategy]
+    shots, latencies = Counter(), Counter()
+    timer = timeit.default_timer
+
+    started = timer()
+    for _ in range(games):
+        fleet = (engine.create_fleet(raw_fleet) if raw_fleet
+                 else engine.generate_fleet())
+        # Only the opponent bombs are played, against the player's fleet
+        battle = engine.Battle(engine.Side([]), engine.Side(fleet))
+        bomber = bomber_class(battle)
+        while not battle.game_over:
+            move_started = timer()
+            bomber.bomb_ships()
+            latencies[int((timer() - move_started) * 1000000)] += 1
+        shots[len(battle.opponent.bombs)] += 1
+
+    return shots, latencies, timer() - started
+
+
+def percentile(counter, fraction):
+    """Returns the value below which the given fraction of the counted
+    values fall"""
+    target = fraction * sum(counter.values())
+    accumulated = 0
+    for value in sorted(counter):
+        accumulated += counter[value]
+        if accumulated >= target:
+            return value
+
+
+def summary(counter):
+    """Returns the mean and the main percentiles of the counted values"""
+    total = sum(counter.values())
+    mean = float(sum(value * count for value, count in counter.items())) / total
+    return 'mean {:.2f}, min {}, p50 {}, p90 {}, p99 {}, max {}'.format(
+        mean, min(counter), percentile(counter, 0.5),
+        percentile(counter, 0.9), percentile(counter, 0.99), max(counter))
+
+
+def simulate(strategy, games, processes, raw_fleet=None, seed=None):
+    """Plays the games in chunks across a pool of processes and returns the
+    merged shots and latencies Counters and the wall clock seconds"""
+    seed = random.randint(0, sys.maxint) if seed is None else seed
+    jobs = []
+    for chunk, first_game in enumerate(range(0, games, CHUNK_SIZE)):
+        jobs.append((strategy, min(CHUNK_SIZE, games - first_game),
+                     raw_fleet, seed + chunk))
+
+    shots, latencies = Counter(), Counter()
+    started = timeit.default_timer()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunk_shots, chunk_latencies, _ in pool.imap_unordered(
+                play_games, jobs):
+            shots.update(chunk_shots)
+            latencies.update(chunk_latencies)
+    finally:
+        pool.close()
+        pool.join()
+
+    return shots, latencies, timeit.default_timer() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Plays opponent AI games offline and reports its stats')
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--strategy', choices=sorted(OPPONENT_BOMBERS),
+                        action='append', help='defaults to all of them')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--fleet', help='new game json file with the fleet '
+                                        'to play against, defaults to '
+                                        'random fleets')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--max-p99', type=int,
+                        help='fails if the p99 move latency in microseconds '
+                             'is over this value')
+    args = parser.parse_args(argv)
+
+    raw_fleet = load_fleet(args.fleet) if args.fleet else None
+    failed = False
+    for strategy in args.strategy or sorted(OPPONENT_BOMBERS):
+        shots, latencies, elapsed = simulate(
+            strategy, args.games, args.processes, raw_fleet, args.seed)
+        print('Strategy: {}'.format(strategy))
+        print('  Games: {} in {:.2f}s, {:.0f} games/s over {} processes'.format(
+            args.games, elapsed, args.games / elapsed, args.processes))
+        print('  Shots to win: {}'.format(summary(shots)))
+        print('  Move latency (us): {}'.format(summary(latencies)))
+
+        if args.max_p99 is not None and \
+                percentile(latencies, 0.99) > args.max_p99:
+            print('  p99 move latency over {}us!'.format(args.max_p99))
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,7 @@
 tests.py: Unit testing for endpoints and Helper functions
 """
 
+import json
 import os
 import sys
 import unittest
@@ -18,23 +19,60 @@ sys.path.insert(1, '{}/lib/yaml/lib'.format(GAE_ROOT))
 sys.path.insert(1, '{}/lib/endpoints-1.0'.format(GAE_ROOT))
 sys.path.insert(1, '{}/lib/protorpc-1.0'.format(GAE_ROOT))
 sys.path.insert(1, '{}/lib/fancy_urllib'.format(GAE_ROOT))
+sys.path.insert(1, '{}/lib/webapp2-2.5.2'.format(GAE_ROOT))
+sys.path.insert(1, '{}/lib/webob-1.1.1'.format(GAE_ROOT))
 
+import urlparse
+
+import webapp2
 from google.appengine.ext import testbed
+from endpoints import BadRequestException
+from endpoints import ConflictException
 from endpoints import NotFoundException
 from protorpc import message_types
+import main
 from api import SeaBattleApi
 from api import USER_REQUEST
 from api import NEW_GAME_REQUEST
 from api import GET_GAME_REQUEST
+from api import GET_GAME_STATE_REQUEST
+from api import GET_GAME_HISTORY_REQUEST
 from api import MAKE_MOVE_REQUEST
+from api import MAKE_MOVES_REQUEST
 from api import HIGH_SCORES_REQUEST
+from api import PAGE_REQUEST
+from api import USER_PAGE_REQUEST
 from models import User
 from models import Ship
 from models import ShipForm
 from models import Game
 from models import Bomb
+from models import Score
+from models import UserStats
+from models import ActiveGamesCounter
+from bombers import DensityOpponentBomber
+from bombers import OpponentBomber
+from bombers import play_turn
+from engine import Battle
+from engine import OPPONENT
+from engine import PLAYER
+from engine import Side
+from engine import generate_fleet
 from ships import ShipsGenerator
+from simulate import load_fleet
+from simulate import percentile
+from simulate import play_games
 from ships import ShipsManager
+from board import FULL
+from board import NEIGHBOUR_SQUARES
+from board import SQUARES
+from board import mask_squares
+from board import neighbours_mask
+from board import placements
+from board import run
+from board import square_index
+from board import square_label
+from board import squares_mask
 
 
 def get_players_ships():
@@ -92,6 +130,12 @@ def get_players_ships():
     ]
 
 
+def get_fleet():
+    return [Ship.create_ship(ship['type'], ship['star_square'],
+                             ship['orientation'])
+            for ship in get_players_ships()]
+
+
 class GaeTestCase(unittest.TestCase):
     def setUp(self):
         super(GaeTestCase, self).setUp()
@@ -106,36 +150,47 @@ class GaeTestCase(unittest.TestCase):
         self.testbed.deactivate()
         super(GaeTestCase, self).tearDown()
 
+    def run_tasks(self, url):
+        taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = taskqueue_stub.get_filtered_tasks(url=url)
+        taskqueue_stub.FlushQueue('default')
+        for task in tasks:
+            request = webapp2.Request.blank(
+                url, POST=dict(urlparse.parse_qsl(task.payload)))
+            self.assertEqual(request.get_response(main.app).status_int, 204)
+
 
 class ShipValidationTestCase(unittest.TestCase):
-    def test_check_number_of_ships_by_type(self):
+    def test_get_number_of_ships_errors(self):
         ships = [ShipForm(type=ship['type'], star_square=ship['star_square'],
                           orientation=ship['orientation'])
                  for ship in get_players_ships()]
-        ShipsManager(Ship, ships).check_number_of_ships_by_type()
+        self.assertEqual(
+            ShipsManager(Ship, ships).get_number_of_ships_errors(), [])
         many_ships = ships[:]
         many_ships.append(ships[2])
-        self.assertRaises(
-            ValueError,
-            ShipsManager(Ship, many_ships).check_number_of_ships_by_type)
+        self.assertEqual(
+            ShipsManager(Ship, many_ships).get_number_of_ships_errors(),
+            ['Too many Cruisers'])
 
         few_ships = ships[:]
         del few_ships[0]
-        self.assertRaises(
-            ValueError,
-            ShipsManager(Ship, few_ships).check_number_of_ships_by_type)
+        self.assertEqual(
+            ShipsManager(Ship, few_ships).get_number_of_ships_errors(),
+            ['Too few ships'])
 
         fewer_ships = ships[:]
         del fewer_ships[7]
         del fewer_ships[8]
-        self.assertRaises(
-            ValueError,
-            ShipsManager(Ship, fewer_ships).check_number_of_ships_by_type)
+        self.assertEqual(
+            ShipsManager(Ship, fewer_ships).get_number_of_ships_errors(),
+            ['Too few Submarines'])
 
     def test_validate_square(self):
         Ship.validate_square('A5')
         self.assertRaises(ValueError, Ship.validate_square, 'Q5')
         self.assertRaises(ValueError, Ship.validate_square, 'C20')
+        self.assertRaises(ValueError, Ship.validate_square, 'A01')
 
     def test_validate_type(self):
         Ship.validate_type(Ship.BATTLESHIP)
@@ -169,47 +224,151 @@ class ShipValidationTestCase(unittest.TestCase):
                     orientation=Ship.HORIZONTAL)
         self.assertEqual(ship.squares, ['C4', 'C5', 'C6'])
 
-    def test_check_overlapping_ship(self):
-        ship = Ship.create_ship(Ship.BATTLESHIP, 'D3', Ship.VERTICAL,
-                                save=False)
-        ships = [
-            Ship.create_ship(Ship.CRUISER, 'F6', Ship.HORIZONTAL, save=False)]
-        ShipsManager(Ship, ships).check_overlapping_ship(ship)
-
-        overlapping_ship = Ship.create_ship(Ship.DESTROYER, 'D2',
-                                            Ship.HORIZONTAL, save=False)
-        ships.append(overlapping_ship)
-        self.assertRaises(ValueError,
-                          ShipsManager(Ship, ships).check_overlapping_ship(
-                              ship))
-
-    def test_generate_restricted_grid_boundaries(self):
-        ship_type, orientation = Ship.CRUISER, Ship.VERTICAL
-        restricted_grid_boundaries = ShipsGenerator(
-            Ship).generate_restricted_grid_boundaries(
-            ship_type, orientation)
-        self.assertEqual(restricted_grid_boundaries, [8, 10])
-
-    def test_generate_ship(self):
-        grid_boundaries, ship_type = [10, 7], Ship.BATTLESHIP
-        orientation = Ship.HORIZONTAL
-        ship = ShipsGenerator(Ship).generate_ship(grid_boundaries, ship_type,
-                                                  orientation)
-        self.assertIsInstance(ship, Ship)
-
-    def test_check_nearby_ships(self):
-        generator = ShipsGenerator(Ship)
-        generator.ships = [
-            Ship.create_ship(Ship.CRUISER, 'B6', Ship.HORIZONTAL, save=False)]
+    def test_create_ships_errors(self):
+        ships = [ShipForm(type=ship['type'], star_square=ship['star_square'],
+                          orientation=ship['orientation'])
+                 for ship in get_players_ships()]
+        self.assertEqual(len(ShipsManager(Ship, ships).create_ships()), 10)
+
+        # An identical cruiser and a submarine out of the grid
+        ships[2] = ships[1]
+        ships[9] = ShipForm(type=Ship.SUBMARINE, star_square='K1',
+                            orientation=Ship.VERTICAL)
+        with self.assertRaises(ValueError) as context:
+            ShipsManager(Ship, ships).create_ships()
+        self.assertEqual(
+            str(context.exception),
+            'Cruiser overlapping Cruiser at F6; The letter of the row must be '
+            'between A to J uppercase for Submarine at K1')
+
+    def test_create_ships_not_adjacent(self):
+        ships = [ShipForm(type=ship['type'], star_square=ship['star_square'],
+                          orientation=ship['orientation'])
+                 for ship in get_players_ships()]
+        ShipsManager(Ship, ships, allow_adjacent=False).create_ships()
+
+        ships[9] = ShipForm(type=Ship.SUBMARINE, star_square='A4',
+                            orientation=Ship.VERTICAL)
+        with self.assertRaises(ValueError) as context:
+            ShipsManager(Ship, ships, allow_adjacent=False).create_ships()
+        self.assertEqual(str(context.exception),
+                         'Submarine next to Submarine at A3; '
+                         'Submarine next to Submarine at A5')
 
-        ship = Ship.create_ship(Ship.BATTLESHIP, 'E4', Ship.VERTICAL,
-                                save=False)
-        generator.check_nearby_ships(ship)
+    def test_placements(self):
+        # A cruiser fits in 8 rows of each column and 8 columns of each row
+        self.assertEqual(len(placements(Ship.CRUISER)), 160)
 
-        nearby_ship = Ship.create_ship(Ship.DESTROYER, 'G5', Ship.HORIZONTAL,
-                                       save=False)
-        generator.ships.append(nearby_ship)
-        self.assertRaises(ValueError, generator.check_nearby_ships, ship)
+    def test_generate_opponents_ships(self):
+        generator = ShipsGenerator(Ship)
+        ships = generator.generate_opponents_ships()
+        self.assertEqual(len(ships), 10)
+        # A valid fleet in which no ship touches another one
+        ShipsManager(Ship, ships, allow_adjacent=False).create_ships()
+
+
+class BoardTestCase(unittest.TestCase):
+    def test_square_index(self):
+        self.assertEqual(square_index('A1'), 0)
+        self.assertEqual(square_index('B10'), 19)
+        self.assertEqual(square_label(99), 'J10')
+        for square in ['A11', 'A0', 'K1', 'A01']:
+            self.assertRaises(ValueError, square_index, square)
+
+    def test_ship_mask(self):
+        ship = Ship(type=Ship.DESTROYER, star_square='C9',
+                    orientation=Ship.HORIZONTAL)
+        self.assertEqual(ship.mask, squares_mask(['C9', 'C10']))
+        self.assertEqual(mask_squares(ship.mask), ['C9', 'C10'])
+
+    def test_neighbours_mask(self):
+        # Squares at the edges of the grid don't wrap to the next row
+        self.assertEqual(mask_squares(neighbours_mask(squares_mask(['A10']))),
+                         ['A9', 'B10'])
+        self.assertEqual(
+            mask_squares(neighbours_mask(squares_mask(['E5', 'E6']))),
+            ['D5', 'D6', 'E4', 'E7', 'F5', 'F6'])
+
+    def test_square_tables(self):
+        self.assertIs(square_label(square_index('B10')), intern('B10'))
+        self.assertEqual(NEIGHBOUR_SQUARES[square_index('A1')],
+                         ('B1', None, None, 'A2'))
+        self.assertEqual(run(square_index('J7'), False, 4), (96, 97, 98, 99))
+        self.assertIsNone(run(square_index('J7'), True, 2))
+
+
+class EngineTestCase(unittest.TestCase):
+    def test_play_battle(self):
+        battle = Battle.new_battle(generate_fleet(), generate_fleet())
+        target_squares = [square for ship in battle.player.ships
+                          for square in ship.squares]
+        for square in target_squares:
+            self.assertFalse(battle.game_over)
+            play_turn(battle, square)
+
+        self.assertEqual(battle.winner, PLAYER)
+        self.assertEqual(len(battle.player.sunken_ships), 10)
+        self.assertRaises(ValueError, play_turn, battle, target_squares[0])
+
+    def test_simulate_games(self):
+        raw_fleet = load_fleet(os.path.join(
+            os.path.dirname(__file__), 'test_data', 'new_game.json'))
+        shots, latencies, _ = play_games(('density', 5, raw_fleet, 1))
+        self.assertEqual(sum(shots.values()), 5)
+        self.assertEqual(sum(latencies.values()),
+                         sum(shot * count for shot, count in shots.items()))
+        self.assertTrue(20 <= percentile(shots, 0.5) <= 100)
+
+    def test_density_touching_ships(self):
+        # The player cruiser touches the sunken battleship and every other
+        # square has been missed
+        battle = Battle.new_battle(
+            [Ship(type=Ship.BATTLESHIP, star_square='A1',
+                  orientation=Ship.HORIZONTAL),
+             Ship(type=Ship.CRUISER, star_square='B1',
+                  orientation=Ship.HORIZONTAL)], [])
+        for square in SQUARES:
+            if square not in ['B1', 'B2', 'B3']:
+                battle.drop_bomb(battle.opponent, square)
+        self.assertEqual(battle.opponent.sunken_ships, [0])
+
+        densities = DensityOpponentBomber(battle).get_densities()
+        self.assertEqual([index for index, density in enumerate(densities)
+                          if density], [10, 11, 12])
+
+    def test_fleet_counters(self):
+        # Fleets of any size are defeated when they have no ships left
+        battle = Battle.new_battle(
+            [Ship(type=Ship.DESTROYER, star_square='A1',
+                  orientation=Ship.HORIZONTAL)],
+            [Ship(type=Ship.SUBMARINE, star_square='C3',
+                  orientation=Ship.VERTICAL),
+             Ship(type=Ship.DESTROYER, star_square='E5',
+                  orientation=Ship.VERTICAL)])
+        self.assertEqual((battle.player.ships_left, battle.player.hull_left),
+                         (2, 3))
+
+        for square in ['C3', 'E5', 'A1']:
+            battle.drop_bomb(battle.player, square)
+        self.assertFalse(battle.game_over)
+        self.assertEqual((battle.player.ships_left, battle.player.hull_left),
+                         (1, 1))
+
+        battle.drop_bomb(battle.player, 'F5')
+        self.assertEqual(battle.winner, PLAYER)
+        self.assertEqual(battle.player.hull_left, 0)
+
+    def test_random_free_square(self):
+        side = Side(generate_fleet())
+        squares = set()
+        while side.free_squares:
+            square = side.random_free_square()
+            self.assertNotIn(square, squares)
+            side.drop_bomb(square)
+            squares.add(square)
+
+        self.assertEqual(len(squares), 100)
+        self.assertEqual(side.bombs_mask, FULL)
 
 
 class CreateGameTestCase(GaeTestCase):
@@ -228,6 +387,33 @@ class CreateGameTestCase(GaeTestCase):
 
         response = self.api.create_user(user)
         self.assertEqual(response.message, 'User juanito created!')
+        self.assertEqual(User.get_by_id('juanito').email, 'juanito@gmail.com')
+
+        user.user_name = ' Juanito'
+        self.assertRaises(ConflictException, self.api.create_user, user)
+        user.user_name = 'pepito'
+        self.assertRaises(ConflictException, self.api.create_user, user)
+
+    def test_migrate_user(self):
+        game = Game(player=self.user.key, players_ships=get_fleet(),
+                    opponents_ships=get_fleet())
+        game.put()
+        game.end_game(won=True)
+
+        self.assertTrue(self.user.migrate())
+        user = User.get_by_name('Pepito ')
+        self.assertEqual(user.key.id(), 'pepito')
+        self.assertEqual(game.key.get().player, user.key)
+        self.assertEqual(Score.query(Score.user == user.key).count(), 1)
+        self.assertEqual(UserStats.get_by_id('pepito').wins, 1)
+        self.assertIsNone(self.user.key.get())
+
+    def test_get_by_name_not_migrated(self):
+        # A user whose name only differs in case took the key name first
+        User(id='pepito', name='Pepito').put()
+        self.assertFalse(self.user.migrate())
+        self.assertEqual(User.get_by_name('pepito').key, self.user.key)
+        self.assertEqual(User.get_by_name('PEPITO').key.id(), 'pepito')
 
     def test_new_game(self):
         new_game_request = NEW_GAME_REQUEST.combined_message_class(
@@ -244,6 +430,55 @@ class CreateGameTestCase(GaeTestCase):
         self.assertEqual(len(response.opponent_bombs), 0)
         self.assertEqual(len(response.sunken_players_ships), 0)
 
+    def test_new_game_fleets_state(self):
+        new_game_request = NEW_GAME_REQUEST.combined_message_class(
+            user_name='pepito', ships=get_players_ships())
+        self.api.new_game(new_game_request)
+
+        game = Game.query().get()
+        ship_slots = Game.unpack_ship_slots(game.players_ship_slots)
+        # The battleship at D3 in vertical is the first ship of the fleet
+        self.assertEqual([ship_slots[square_index(square)]
+                          for square in ['D3', 'G3', 'H3']], [0, 0, None])
+        self.assertEqual(game.players_hit_points,
+                         [ship.type for ship in game.players_ships])
+        self.assertEqual(sum(game.opponents_hit_points), 20)
+
+    def test_get_average_attempts(self):
+        new_game_request = NEW_GAME_REQUEST.combined_message_class(
+            user_name='pepito', ships=get_players_ships())
+        game = self.api.new_game(new_game_request)
+        self.run_tasks('/tasks/add_active_games')
+        self.assertEqual(ActiveGamesCounter.totals(), (1, 0))
+
+        bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
+            bomb='A1', urlsafe_game_key=game.urlsafe_key)
+        self.api.make_move(bomb_request)
+        self.run_tasks('/tasks/add_active_games')
+        response = self.api.get_average_attempts(message_types.VoidMessage())
+        self.assertEqual(response.message,
+                         'The average number of dropped bombs are 1.00')
+
+    def test_add_active_games_once(self):
+        ActiveGamesCounter.add_later('test', games=1, bombs=2)
+        # A repeated update is rejected
+        ActiveGamesCounter.add_later('test', games=1, bombs=2)
+        self.run_tasks('/tasks/add_active_games')
+        self.assertEqual(ActiveGamesCounter.totals(), (1, 2))
+
+    def test_reconcile_active_games(self):
+        ActiveGamesCounter.add(games=3, bombs=7)
+        Game(player=self.user.key, players_ships=get_fleet(),
+             opponents_ships=get_fleet()).put()
+
+        request = webapp2.Request.blank('/crons/reconcile_active_games')
+        self.assertEqual(request.get_response(main.app).status_int, 200)
+        # Updates made during the recount are kept
+        ActiveGamesCounter.add(games=1, bombs=2)
+        self.run_tasks('/tasks/reconcile_active_games')
+        self.run_tasks('/tasks/add_active_games')
+        self.assertEqual(ActiveGamesCounter.totals(), (2, 2))
+
 
 class PlayGameTestCase(GaeTestCase):
     def setUp(self):
@@ -251,23 +486,66 @@ class PlayGameTestCase(GaeTestCase):
         self.user = User(name='pepito', email='pepito@gmail.com')
         self.user.put()
 
-        ships = [Ship.create_ship(
-            ship['type'], ship['star_square'], ship['orientation']).key
-                 for ship in get_players_ships()]
-        self.game = Game(player=self.user.key, players_ships=ships,
-                         opponents_ships=ships)
+        self.game = Game(player=self.user.key, players_ships=get_fleet(),
+                         opponents_ships=get_fleet())
         self.game.put()
         self.game_form = self.game.to_form(u'Sink ´em all!')
-        self.opponents_ships = ships
+        self.opponents_ships = self.game.opponents_ships
 
     def test_get_game(self):
-        game_request = GET_GAME_REQUEST.combined_message_class(
+        game_request = GET_GAME_STATE_REQUEST.combined_message_class(
             urlsafe_game_key=self.game_form.urlsafe_key)
         found_game = self.api.get_game(game_request)
 
         self.assertEqual(self.game_form.user_name, found_game.user_name)
         self.assertEqual(self.game_form.players_ships, found_game.players_ships)
 
+    def test_make_moves(self):
+        moves_request = MAKE_MOVES_REQUEST.combined_message_class(
+            bombs=['A3', 'A3', 'F4'],
+            urlsafe_game_key=self.game_form.urlsafe_key)
+        response = self.api.make_moves(moves_request)
+        self.assertEqual(response.results[0].result, 'Hit')
+        self.assertEqual(response.results[1].error,
+                         'That bomb has already been dropped!')
+        self.assertEqual(len(response.results), 2)
+        self.assertEqual(len(response.game.player_bombs), 1)
+        self.assertEqual(len(self.game.key.get().player_bombs), 1)
+
+        moves_request.bombs = [square for ship in self.opponents_ships
+                               for square in ship.squares if square != 'A3']
+        response = self.api.make_moves(moves_request)
+        self.assertEqual(response.game.message, 'You won!')
+        self.assertTrue(response.game.game_over)
+
+    def test_make_move_delta(self):
+        # Sink the opponent submarine at A3
+        bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
+            bomb='A3', known_moves=0,
+            urlsafe_game_key=self.game_form.urlsafe_key)
+        game = self.api.make_move(bomb_request)
+        self.assertTrue(game.delta)
+        self.assertEqual(game.move_count, 1)
+        self.assertEqual(game.players_ships, [])
+        self.assertEqual(len(game.player_bombs), 1)
+        self.assertEqual(len(game.sunken_opponents_ships), 1)
+        self.assertEqual(game.opponents_ships_left, 9)
+
+        bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
+            bomb='F4', known_moves=game.move_count,
+            urlsafe_game_key=self.game_form.urlsafe_key)
+        game = self.api.make_move(bomb_request)
+        self.assertEqual([bomb.target_square for bomb in game.player_bombs],
+                         ['F4'])
+        self.assertEqual(game.sunken_opponents_ships, [])
+        self.assertEqual(game.move_count, 2 + len(game.opponent_bombs))
+
+        game_request = GET_GAME_STATE_REQUEST.combined_message_class(
+            urlsafe_game_key=self.game_form.urlsafe_key,
+            known_moves=game.move_count)
+        game = self.api.get_game(game_request)
+        self.assertEqual(game.player_bombs + game.opponent_bombs, [])
+
     def test_make_move(self):
         mis_bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
             bomb='F4', urlsafe_game_key=self.game_form.urlsafe_key)
@@ -277,8 +555,7 @@ class PlayGameTestCase(GaeTestCase):
 
         self.assertGreaterEqual(len(game.opponent_bombs), 1)
 
-        opponent_ship_square = self.opponents_ships[
-            0].get().to_form().star_square
+        opponent_ship_square = self.opponents_ships[0].star_square
         hit_bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
             bomb=opponent_ship_square,
             urlsafe_game_key=self.game_form.urlsafe_key)
@@ -286,7 +563,7 @@ class PlayGameTestCase(GaeTestCase):
         self.assertEqual(game.message, 'Hit')
         self.assertEqual(len(game.sunken_opponents_ships), 0)
 
-        for ship in [ship_key.get() for ship_key in self.opponents_ships]:
+        for ship in self.opponents_ships:
             if ship.type == Ship.SUBMARINE:
                 opponent_ship_square = ship.to_form().star_square
                 break
@@ -297,6 +574,38 @@ class PlayGameTestCase(GaeTestCase):
         self.assertEqual(game.message, 'Hit')
         self.assertEqual(len(game.sunken_opponents_ships), 1)
 
+    def test_retry_move(self):
+        bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
+            bomb='F4', move_id='move-1',
+            urlsafe_game_key=self.game_form.urlsafe_key)
+        game = self.api.make_move(bomb_request)
+        retried_game = self.api.make_move(bomb_request)
+        self.assertEqual(retried_game.message, game.message)
+        self.assertEqual(len(retried_game.player_bombs), 1)
+        self.assertEqual(len(retried_game.opponent_bombs),
+                         len(game.opponent_bombs))
+
+    def test_density_opponent_bomber(self):
+        self.game.add_move(OPPONENT, 'D3')
+        battle = self.game.to_battle()
+        DensityOpponentBomber(battle).bomb_ships()
+        self.assertIn(battle.opponent.bombs[-1].target_square,
+                      ['C3', 'E3', 'D2', 'D4'])
+
+    def test_opponent_target(self):
+        # Two hits on the player battleship at D3 in vertical
+        self.game.add_move(OPPONENT, 'D3')
+        self.game.add_move(OPPONENT, 'E3')
+        battle = self.game.to_battle()
+        OpponentBomber(battle).bomb_ships()
+        self.assertEqual(battle.opponent.bombs[-1].target_square, 'C3')
+
+        self.game.save_battle(battle)
+        target = self.game.key.get().opponent_target
+        self.assertEqual(target.hits, [square_index('D3'), square_index('E3')])
+        self.assertEqual(target.orientation, Ship.VERTICAL)
+        self.assertEqual(target.frontier[0], square_index('F3'))
+
     def test_get_game_history(self):
         first_bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
             bomb='F4', urlsafe_game_key=self.game_form.urlsafe_key)
@@ -306,17 +615,140 @@ class PlayGameTestCase(GaeTestCase):
             bomb='F5', urlsafe_game_key=self.game_form.urlsafe_key)
         self.api.make_move(second_bomb_request)
 
-        game_request = GET_GAME_REQUEST.combined_message_class(
+        game_request = GET_GAME_HISTORY_REQUEST.combined_message_class(
             urlsafe_game_key=self.game_form.urlsafe_key)
         game = self.api.get_game_history(game_request)
         self.assertEqual(len(game.player_bombs), 2)
 
 
+class MigrateGameTestCase(GaeTestCase):
+    def test_embed_legacy_entities(self):
+        user = User(name='pepito', email='pepito@gmail.com')
+        user.put()
+        ships = [ship.put() for ship in get_fleet()]
+        bomb = Bomb(target_square='A3', result=Bomb.HIT)
+        bomb.put()
+        game = Game(player=user.key, legacy_players_ships=ships,
+                    legacy_opponents_ships=ships,
+                    legacy_player_bombs=[bomb.key],
+                    legacy_sunken_opponents_ships=[ships[7]])
+        game.put()
+
+        self.assertTrue(game.embed_legacy_entities())
+        game.put()
+        game = game.key.get()
+        self.assertEqual(len(game.players_ships), 10)
+        self.assertEqual(game.player_bombs[0].target_square, 'A3')
+        self.assertEqual(game.sunken_opponents_ships, [7])
+        self.assertTrue(game.opponents_ships[7].sunken)
+        self.assertEqual(game.legacy_players_ships, [])
+        self.assertFalse(game.embed_legacy_entities())
+
+    def test_embed_legacy_game(self):
+        user = User(name='pepito', email='pepito@gmail.com')
+        user.put()
+        ships = [ship.put() for ship in get_fleet()]
+        game = Game(player=user.key, legacy_players_ships=ships,
+                    legacy_opponents_ships=ships)
+        game.put()
+
+        migrated = Game.embed_legacy_game(game.key)
+        migrated.add_move(PLAYER, 'A3')
+        migrated.put()
+        # A migration started from the legacy game keeps the committed move
+        game = Game.embed_legacy_game(game.key)
+        self.assertEqual(game.get_moves(), [(PLAYER, 'A3')])
+        self.assertEqual(len(game.players_ships), 10)
+
+    def test_make_move_legacy_game(self):
+        user = User(name='pepito', email='pepito@gmail.com')
+        user.put()
+        ships = [ship.put() for ship in get_fleet()]
+        game = Game(player=user.key, legacy_players_ships=ships,
+                    legacy_opponents_ships=ships)
+        game.put()
+
+        bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
+            bomb='A3', urlsafe_game_key=game.key.urlsafe())
+        response = self.api.make_move(bomb_request)
+        self.assertEqual(response.message, 'Hit')
+        self.assertEqual(response.user_name, 'pepito')
+        game = game.key.get()
+        self.assertEqual(game.legacy_keys, [])
+        self.assertEqual(game.get_moves()[0], (PLAYER, 'A3'))
+
+    def test_migrate_games(self):
+        user = User(name='pepito', email='pepito@gmail.com')
+        user.put()
+        ships = [ship.put() for ship in get_fleet()]
+        bomb = Bomb(target_square='A3', result=Bomb.HIT)
+        bomb.put()
+        game = Game(player=user.key, legacy_players_ships=ships,
+                    legacy_opponents_ships=ships,
+                    legacy_player_bombs=[bomb.key])
+        game.put()
+
+        request = webapp2.Request.blank('/tasks/migrate_games', POST={})
+        self.assertEqual(request.get_response(main.app).status_int, 204)
+        game = game.key.get()
+        self.assertEqual(game.legacy_keys, [])
+        self.assertEqual(game.get_moves(), [(PLAYER, 'A3')])
+        # The old Ship and Bomb entities are removed
+        self.assertEqual(Ship.query().count(), 0)
+        self.assertEqual(Bomb.query().count(), 0)
+
+    def test_embed_legacy_entities_missing_ship(self):
+        user = User(name='pepito', email='pepito@gmail.com')
+        user.put()
+        ships = [ship.put() for ship in get_fleet()]
+        ships[0].delete()
+        game = Game(player=user.key, legacy_players_ships=ships,
+                    legacy_opponents_ships=ships,
+                    legacy_sunken_opponents_ships=[ships[0], ships[7]])
+        game.put()
+
+        self.assertTrue(game.embed_legacy_entities())
+        self.assertEqual(len(game.opponents_ships), 9)
+        self.assertEqual(game.sunken_opponents_ships, [6])
+        self.assertEqual(game.opponents_ships[6].star_square, 'A8')
+        self.assertTrue(game.opponents_ships[6].sunken)
+
+    def test_embed_legacy_bombs(self):
+        user = User(name='pepito', email='pepito@gmail.com')
+        user.put()
+        ships = [ship.put() for ship in get_fleet()]
+        player_bombs = [bomb.put() for bomb in [
+            Bomb(target_square='A3', result=Bomb.HIT),
+            Bomb(target_square='F4', result=Bomb.MIS)]]
+        opponent_bombs = [bomb.put() for bomb in [
+            Bomb(target_square='B1', result=Bomb.HIT),
+            Bomb(target_square='A1', result=Bomb.MIS)]]
+        game = Game(player=user.key, legacy_players_ships=ships,
+                    legacy_opponents_ships=ships,
+                    legacy_player_bombs=player_bombs,
+                    legacy_opponent_bombs=opponent_bombs)
+        game.put()
+
+        self.assertTrue(game.embed_legacy_entities())
+        game.put()
+        self.assertEqual(game.get_moves(),
+                         [(PLAYER, 'A3'), (PLAYER, 'F4'),
+                          (OPPONENT, 'B1'), (OPPONENT, 'A1')])
+        self.assertEqual(len(game.moves), 4)
+        self.assertEqual([bomb.result for bomb in game.opponent_bombs],
+                         [Bomb.HIT, Bomb.MIS])
+
+        history_request = GET_GAME_HISTORY_REQUEST.combined_message_class(
+            urlsafe_game_key=game.key.urlsafe(), encoded=True)
+        history = self.api.get_game_history(history_request)
+        self.assertEqual(history.encoded_moves, game.moves)
+        self.assertEqual(history.player_bombs, [])
+
+
 class FinishGameTestCase(PlayGameTestCase):
     def test_win_a_game(self):
         game = None
-        for opponent_ship in [ship_key.get() for ship_key in
-                              self.opponents_ships]:
+        for opponent_ship in self.opponents_ships:
             for hit_bomb in opponent_ship.squares:
                 hit_bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
                     bomb=hit_bomb, urlsafe_game_key=self.game_form.urlsafe_key)
@@ -327,14 +759,13 @@ class FinishGameTestCase(PlayGameTestCase):
 
     def test_lose_a_game(self):
         # Bomb all player ships except for the first.
-        for ship in self.game.players_ships[1:]:
-            self.game.sunken_players_ships.append(ship)
+        self.game.sunken_players_ships.extend(
+            range(1, len(self.game.players_ships)))
 
         # Bomb the first player ships except for the last square.
-        for hit_bomb in self.game.players_ships[0].get().squares[:-1]:
-            bomb = Bomb(target_square=hit_bomb, result=Bomb.HIT)
-            bomb.put()
-            self.game.opponent_bombs.append(bomb.key)
+        for hit_bomb in self.game.players_ships[0].squares[:-1]:
+            self.game.add_move(OPPONENT, hit_bomb)
+        self.game.put()
 
         # Make a dummy move so the opponent will
         # sink the last player ship and win the game.
@@ -357,30 +788,26 @@ class GameScoresTestCase(GaeTestCase):
         user = User(name='pepito', email='pepito@gmail.com')
         user.put()
 
-        ships = [Ship.create_ship(
-            ship['type'], ship['star_square'], ship['orientation']).key
-                 for ship in get_players_ships()]
-        self.opponents_ships = ships
+        self.opponents_ships = get_fleet()
 
-        self.first_game = self.create_game(user, ships)
-        self.second_game = self.create_game(user, ships)
+        self.first_game = self.create_game(user)
+        self.second_game = self.create_game(user)
 
         second_user = User(name='juanito', email='juanito@gmail.com')
         second_user.put()
-        self.third_game = self.create_game(second_user, ships)
+        self.third_game = self.create_game(second_user)
 
-        fourth_game = Game(player=second_user.key, players_ships=ships,
-                           opponents_ships=ships)
+        fourth_game = Game(player=second_user.key, players_ships=get_fleet(),
+                           opponents_ships=get_fleet())
         fourth_game.put()
 
-    def create_game(self, user, ships):
-        game = Game(player=user.key, players_ships=ships,
-                    opponents_ships=ships)
+    def create_game(self, user):
+        game = Game(player=user.key, players_ships=get_fleet(),
+                    opponents_ships=get_fleet())
         game.put()
         game_form = game.to_form(u'Sink ´em all!')
 
-        for opponent_ship in [ship_key.get() for ship_key in
-                              self.opponents_ships]:
+        for opponent_ship in self.opponents_ships:
             for hit_bomb in opponent_ship.squares:
                 hit_bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
                     bomb=hit_bomb, urlsafe_game_key=game_form.urlsafe_key)
@@ -389,16 +816,33 @@ class GameScoresTestCase(GaeTestCase):
         return game
 
     def test_get_scores(self):
-        response = self.api.get_scores(message_types.VoidMessage())
+        response = self.api.get_scores(PAGE_REQUEST.combined_message_class())
         self.assertEqual(response.items[0].bombs,
                          len(self.first_game.player_bombs))
         self.assertEqual(response.items[1].bombs,
                          len(self.second_game.player_bombs))
         self.assertTrue(response.items[1].won)
+        self.assertIsNone(response.next_page_token)
+
+    def test_get_scores_pages(self):
+        response = self.api.get_scores(
+            PAGE_REQUEST.combined_message_class(page_size=2))
+        self.assertEqual(len(response.items), 2)
+        next_response = self.api.get_scores(
+            PAGE_REQUEST.combined_message_class(
+                page_size=2, page_token=response.next_page_token))
+        self.assertEqual(len(next_response.items), 1)
+        self.assertIsNone(next_response.next_page_token)
+        self.assertRaises(BadRequestException, self.api.get_scores,
+                          PAGE_REQUEST.combined_message_class(page_size=-1))
+
+    def test_score_forms(self):
+        forms = Score.to_forms(Score.query().fetch())
+        self.assertEqual(sorted(set(form.user_name for form in forms)),
+                         ['juanito', 'pepito'])
 
     def test_get_user_scores(self):
-        user = USER_REQUEST.combined_message_class(
-            user_name='pepito', email='pepito@gmail.com')
+        user = USER_PAGE_REQUEST.combined_message_class(user_name='pepito')
         response = self.api.get_user_scores(user)
         self.assertEqual(len(response.items), 2)
 
@@ -415,24 +859,20 @@ class HighScoresTestCase(GaeTestCase):
         user = User(name='pepito', email='pepito@gmail.com')
         user.put()
 
-        ships = [Ship.create_ship(
-            ship['type'], ship['star_square'], ship['orientation']).key
-                 for ship in get_players_ships()]
-        self.opponents_ships = ships
+        self.opponents_ships = get_fleet()
 
-        self.first_game = self.create_game(user, ships)
-        self.second_game = self.create_game(user, ships)
-        self.third_game = self.create_game(user, ships)
+        self.first_game = self.create_game(user)
+        self.second_game = self.create_game(user)
+        self.third_game = self.create_game(user)
 
-    def create_game(self, user, ships):
-        game = Game(player=user.key, players_ships=ships,
-                    opponents_ships=ships)
+    def create_game(self, user):
+        game = Game(player=user.key, players_ships=get_fleet(),
+                    opponents_ships=get_fleet())
         game.put()
         return game.to_form(u'Sink ´em all!')
 
     def win_game(self, game):
-        for opponent_ship in [ship_key.get() for ship_key in
-                              self.opponents_ships]:
+        for opponent_ship in self.opponents_ships:
             for hit_bomb in opponent_ship.squares:
                 hit_bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
                     bomb=hit_bomb, urlsafe_game_key=game.urlsafe_key)
@@ -455,6 +895,24 @@ class HighScoresTestCase(GaeTestCase):
         self.assertEqual(response.items[0].bombs,
                          len(self.third_game.player_bombs))
 
+    def test_update_cached_high_scores(self):
+        self.win_game(self.second_game)
+        high_scores_request = HIGH_SCORES_REQUEST.combined_message_class(
+            period='daily')
+        response = self.api.get_high_scores(high_scores_request)
+        self.assertEqual(len(response.items), 1)
+
+        # The cached board gets the new won game without being rebuilt
+        Score.query().fetch()[0].key.delete()
+        self.win_game(self.third_game)
+        response = self.api.get_high_scores(high_scores_request)
+        self.assertEqual([item.user_name for item in response.items],
+                         ['pepito', 'pepito'])
+
+        high_scores_request.period = 'weekly'
+        self.assertRaises(BadRequestException, self.api.get_high_scores,
+                          high_scores_request)
+
 
 class UserRankingsTestCase(GaeTestCase):
     def setUp(self):
@@ -464,26 +922,22 @@ class UserRankingsTestCase(GaeTestCase):
         user_2 = User(name='juanito', email='juanito@gmail.com')
         user_2.put()
 
-        ships = [Ship.create_ship(
-            ship['type'], ship['star_square'], ship['orientation']).key
-                 for ship in get_players_ships()]
-        self.opponents_ships = ships
+        self.opponents_ships = get_fleet()
 
-        self.first_game = self.create_game(user, ships)
-        self.second_game = self.create_game(user_2, ships)
-        self.third_game = self.create_game(user_2, ships)
-        self.fourth_game = self.create_game(user_2, ships)
-        self.fifth_game = self.create_game(user_2, ships)
+        self.first_game = self.create_game(user)
+        self.second_game = self.create_game(user_2)
+        self.third_game = self.create_game(user_2)
+        self.fourth_game = self.create_game(user_2)
+        self.fifth_game = self.create_game(user_2)
 
-    def create_game(self, user, ships):
-        game = Game(player=user.key, players_ships=ships,
-                    opponents_ships=ships)
+    def create_game(self, user):
+        game = Game(player=user.key, players_ships=get_fleet(),
+                    opponents_ships=get_fleet())
         game.put()
         return game
 
     def win_game(self, game):
-        for opponent_ship in [ship_key.get() for ship_key in
-                              self.opponents_ships]:
+        for opponent_ship in self.opponents_ships:
             for hit_bomb in opponent_ship.squares:
                 hit_bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
                     bomb=hit_bomb, urlsafe_game_key=game.urlsafe_key)
@@ -493,14 +947,12 @@ class UserRankingsTestCase(GaeTestCase):
 
     def lose_game(self, game):
         # Bomb all player ships except for the first.
-        for ship in game.players_ships[1:]:
-            game.sunken_players_ships.append(ship)
+        game.sunken_players_ships.extend(range(1, len(game.players_ships)))
 
         # Bomb the first player ships except for the last square.
-        for hit_bomb in game.players_ships[0].get().squares[:-1]:
-            bomb = Bomb(target_square=hit_bomb, result=Bomb.HIT)
-            bomb.put()
-            game.opponent_bombs.append(bomb.key)
+        for hit_bomb in game.players_ships[0].squares[:-1]:
+            game.add_move(OPPONENT, hit_bomb)
+        game.put()
 
         # Make a dummy move so the opponent will
         # sink the last player ship and win the game.
@@ -520,11 +972,60 @@ class UserRankingsTestCase(GaeTestCase):
         self.win_game(self.fourth_game.to_form(''))
         self.lose_game(self.fifth_game)
 
-        response = self.api.get_user_rankings(message_types.VoidMessage())
+        response = self.api.get_user_rankings(
+            PAGE_REQUEST.combined_message_class())
         self.assertEqual(response.items[0].name, 'juanito')
         self.assertEqual(response.items[0].performance, 1.5)
         self.assertEqual(response.items[1].name, 'pepito')
         self.assertEqual(response.items[1].performance, 1)
+        self.assertIsNone(response.next_page_token)
+
+    def test_get_user_rankings_pages(self):
+        self.win_game(self.first_game.to_form(''))
+        self.lose_game(self.second_game)
+
+        response = self.api.get_user_rankings(
+            PAGE_REQUEST.combined_message_class(page_size=1))
+        self.assertEqual([item.name for item in response.items], ['pepito'])
+        response = self.api.get_user_rankings(
+            PAGE_REQUEST.combined_message_class(
+                page_size=1, page_token=response.next_page_token))
+        self.assertEqual([item.name for item in response.items], ['juanito'])
+        self.assertEqual(response.items[0].performance, 0)
+
+
+class ReminderTestCase(PlayGameTestCase):
+    def test_send_reminders(self):
+        Game(player=self.user.key, players_ships=get_fleet(),
+             opponents_ships=get_fleet()).put()
+        mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+
+        for _ in range(2):
+            request = webapp2.Request.blank('/tasks/fan_out_reminders',
+                                            POST={})
+            self.assertEqual(request.get_response(main.app).status_int, 204)
+            self.run_tasks('/tasks/send_reminder_digests')
+
+        # A single reminder with both games, the user isn't mailed again
+        messages = mail_stub.get_sent_messages(to='pepito@gmail.com')
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].body.decode().count('urlsafe_game_key'),
+                         2)
+        self.assertIsNotNone(self.user.key.get().last_reminded)
+
+    def test_send_reminders_only_for_own_games(self):
+        other_user = User(name='juanito', email='juanito@gmail.com')
+        other_user.put()
+        digests = [{'user': other_user.key.urlsafe(),
+                    'games': [self.game.key.urlsafe()]}]
+        request = webapp2.Request.blank(
+            '/tasks/send_reminder_digests',
+            POST={'digests': json.dumps(digests)})
+        self.assertEqual(request.get_response(main.app).status_int, 204)
+
+        mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.assertEqual(mail_stub.get_sent_messages(), [])
+        self.assertIsNone(other_user.key.get().last_reminded)
 
 
 class CancelGameTestCase(PlayGameTestCase):
@@ -533,6 +1034,14 @@ class CancelGameTestCase(PlayGameTestCase):
             urlsafe_game_key=self.game_form.urlsafe_key)
         self.api.cancel_game(game_request)
         self.assertRaises(NotFoundException, self.api.get_game, game_request)
+        bomb_request = MAKE_MOVE_REQUEST.combined_message_class(
+            bomb='F4', urlsafe_game_key=self.game_form.urlsafe_key)
+        self.assertRaises(NotFoundException, self.api.make_move,
+                          bomb_request)
+        bombs_request = MAKE_MOVES_REQUEST.combined_message_class(
+            bombs=['F4'], urlsafe_game_key=self.game_form.urlsafe_key)
+        self.assertRaises(NotFoundException, self.api.make_moves,
+                          bombs_request)
 
 
 if __name__ == '__main__':
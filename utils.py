@@ -3,23 +3,26 @@ utils.py - File for collecting general utility functions.
 """
 
 import endpoints
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 __author__ = 'Andres Anies'
 __email__ = 'andres_anies@hotmail.com'
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string points to, without
+        getting its entity. Raises an error if the key String is malformed
+        or the key is of the incorrect kind
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The Key of the urlsafe Key string.
     Raises:
         ValueError:"""
     try:
@@ -32,9 +35,48 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    return get_key_by_urlsafe(urlsafe, model).get()
+
+
+def fetch_page(query, page_size=None, page_token=None):
+    """Returns a page of the results of a query and the token of the next
+    page. Raises an error if the page size is negative or the page token is
+    malformed
+    Args:
+        query: An ordered ndb.Query
+        page_size: The number of results, DEFAULT_PAGE_SIZE if not given and
+            at most MAX_PAGE_SIZE
+        page_token: The urlsafe cursor returned along the previous page
+    Returns:
+        The list of entities of the page and the next page token or None if
+        there are no more results."""
+    if page_size is not None and page_size < 0:
+        raise endpoints.BadRequestException('Invalid page size')
+    page_size = min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    try:
+        cursor = Cursor(urlsafe=page_token)
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid page token')
+
+    entities, next_cursor, more = query.fetch_page(page_size,
+                                                   start_cursor=cursor)
+    next_page_token = next_cursor.urlsafe() if more and next_cursor else None
+    return entities, next_page_token